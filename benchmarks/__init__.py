@@ -0,0 +1,5 @@
+"""
+Benchmarks for discovery and config space access, run against generated
+sysfs trees so they need neither the hardware nor root.  See synthetic.py for
+the trees and bench.py for what's measured.
+"""
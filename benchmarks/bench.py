@@ -0,0 +1,260 @@
+"""
+Discovery and config space access benchmarks
+
+Generates a synthetic tree (see synthetic.py), times discovery and register
+access on it and compares the results to a stored baseline:
+
+    python -m benchmarks.bench --save baseline.json
+    ... change things ...
+    python -m benchmarks.bench --baseline baseline.json
+
+Every result is lower-is-better, timings are the best of --repeat runs.  A
+result more than --tolerance over its baseline is reported as a regression
+and makes the run exit non-zero.  --sysfs runs the read only benchmarks
+against an existing tree instead, ex: the real /sys.
+"""
+
+import os, sys, gc, json, shutil, tempfile, optparse, multiprocessing
+from timeit import default_timer
+from pcitweak.devices import PCIDevices
+from pcitweak.config import PCIConfigSpace, PCIConfigSpaceAccess, scan_capabilities
+from benchmarks.synthetic import Topology, generate
+
+baseline_version = 1
+
+# Registers and fields the access benchmarks go through, every PCIe
+# function has them
+read_reg = "pcie_device_control"
+read_field = "pcie_link_status_negotiated_link_width"
+write_field = "pcie_device_control_max_read_request_size"
+
+# (name, unit, description) of every result, in report order
+results_info = [
+    ("discover", "ms", "eager discovery, every config space parsed"),
+    ("discover_lazy", "ms", "lazy discovery, IDs only"),
+    ("discover_threads", "ms", "eager discovery on 4 threads"),
+    ("discover_cached", "ms", "discovery from a warm cache"),
+    ("rescan", "ms", "rescan with nothing changed"),
+    ("read_reg", "us", "register read through sysfs"),
+    ("read_field", "us", "bit field read through sysfs"),
+    ("read_snapshot", "us", "register read from a snapshot"),
+    ("write_field", "us", "bit field read-modify-write through sysfs"),
+    ("cap_walk", "us", "capability walk per device, image in memory"),
+    ("config_parse", "us", "read and parse one config space"),
+    ("memory", "KB", "memory per device, eager"),
+    ("memory_lazy", "KB", "memory per device, lazy"),
+]
+
+def best_of(repeat, fn, *args, **kwargs):
+    "Smallest wall time of repeat calls of fn, in seconds"
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        start = default_timer()
+        fn(*args, **kwargs)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def resident_kb():
+    "Resident set size of this process"
+    f = open("/proc/self/statm")
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024.0
+
+def _memory_worker(sysfs_root, lazy, queue):
+    gc.collect()
+    before = resident_kb()
+    dl = PCIDevices(lazy=lazy, sysfs_root=sysfs_root)
+    gc.collect()
+    queue.put((resident_kb() - before) / max(len(dl.devices), 1))
+
+def memory_per_device(sysfs_root, lazy=False):
+    "KB of memory a PCIDevices takes per device, measured in a fresh process"
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_memory_worker, args=(sysfs_root, lazy, queue))
+    proc.start()
+    try:
+        return queue.get()
+    finally:
+        proc.join()
+
+def pcie_devices(dl, count):
+    "Up to count devices with a PCI Express capability, spread over the tree"
+    devs = [dev for dev in dl.devices if dev.config is not None and dev.config.has_capability(0x10)]
+    step = max(len(devs) / count, 1)
+    return devs[::step][:count]
+
+def _read_all(devs, name, loops):
+    for i in range(loops):
+        for dev in devs:
+            dev.config.read(name)
+
+def _write_all(devs, name, values, loops):
+    for i in range(loops):
+        for dev, value in zip(devs, values):
+            dev.config.write(name, value)
+
+def _walk_all(images):
+    for data in images:
+        scan_capabilities(data)
+
+def _parse_all(devs):
+    for dev in devs:
+        access = PCIConfigSpaceAccess(os.path.join(dev.path, "config"), dev)
+        PCIConfigSpace(access)
+        access.close()
+
+def run(sysfs_root, repeat=5, samples=256, loops=20, writes=True):
+    "{result name: value} for the tree at sysfs_root, see results_info"
+    results = {}
+
+    # Before anything else is built, so the fork doesn't carry it along
+    results["memory"] = memory_per_device(sysfs_root)
+    results["memory_lazy"] = memory_per_device(sysfs_root, lazy=True)
+
+    results["discover"] = best_of(repeat, PCIDevices, sysfs_root=sysfs_root) * 1e3
+    results["discover_lazy"] = best_of(repeat, PCIDevices, lazy=True, sysfs_root=sysfs_root) * 1e3
+    results["discover_threads"] = best_of(repeat, PCIDevices, threads=4, sysfs_root=sysfs_root) * 1e3
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = os.path.join(cache_dir, "devices.json")
+        PCIDevices(lazy=True, cache=cache, sysfs_root=sysfs_root)
+        if os.path.exists(cache):
+            results["discover_cached"] = best_of(repeat, PCIDevices, cache=cache, sysfs_root=sysfs_root) * 1e3
+    finally:
+        shutil.rmtree(cache_dir)
+
+    dl = PCIDevices(sysfs_root=sysfs_root)
+    results["rescan"] = best_of(repeat, dl.rescan) * 1e3
+
+    devs = pcie_devices(dl, samples)
+    count = max(len(devs) * loops, 1)
+    results["read_reg"] = best_of(repeat, _read_all, devs, read_reg, loops) * 1e6 / count
+    results["read_field"] = best_of(repeat, _read_all, devs, read_field, loops) * 1e6 / count
+
+    if writes:
+        # Write back what's there, the tree is left as it was
+        values = [dev.config.read(write_field) for dev in devs]
+        results["write_field"] = best_of(repeat, _write_all, devs, write_field, values, loops) * 1e6 / count
+
+    images = [dev.config.config.read_block(0, dev.config.config.size()) for dev in devs]
+    results["cap_walk"] = best_of(repeat, _walk_all, images) * 1e6 / max(len(images), 1)
+    results["config_parse"] = best_of(repeat, _parse_all, devs) * 1e6 / max(len(devs), 1)
+
+    snap = PCIDevices(snapshot=True, sysfs_root=sysfs_root)
+    snap_devs = pcie_devices(snap, samples)
+    results["read_snapshot"] = best_of(repeat, _read_all, snap_devs, read_reg, loops) * 1e6 / max(len(snap_devs) * loops, 1)
+
+    results["devices"] = len(dl.devices)
+    return results
+
+def compare(results, baseline):
+    "[(name, value, baseline value, change)] with change None if there's no baseline value"
+    ret = []
+    for name, unit, description in results_info:
+        if name not in results:
+            continue
+        base = baseline.get(name)
+        change = None
+        if base:
+            change = (results[name] - base) / base
+        ret.append((name, results[name], base, change))
+    return ret
+
+def report(results, baseline=None, tolerance=0.25, out=sys.stdout):
+    "Print the results against the baseline's, returns the names that regressed"
+    regressed = []
+    units = dict([(name, unit) for name, unit, description in results_info])
+    descriptions = dict([(name, description) for name, unit, description in results_info])
+    if baseline is None:
+        baseline = {}
+
+    print >>out, "%d devices" % (results["devices"])
+    print >>out, "%-18s %12s %12s %8s" % ("", "result", "baseline", "change")
+    for name, value, base, change in compare(results, baseline):
+        flag = ""
+        if change is not None and change > tolerance:
+            flag = "REGRESSION"
+            regressed.append(name)
+        if change is None:
+            base_str, change_str = "-", "-"
+        else:
+            base_str, change_str = "%.3f" % (base), "%+.1f%%" % (change * 100)
+        print >>out, "%-18s %9.3f %-2s %12s %8s  %-45s %s" % (name, value, units[name], base_str, change_str,
+                                                              descriptions[name], flag)
+    return regressed
+
+def load_baseline(filename):
+    f = open(filename)
+    try:
+        saved = json.load(f)
+    finally:
+        f.close()
+    if saved.get("version") != baseline_version:
+        raise RuntimeError("Baseline %s is from an incompatible version" % (filename))
+    return saved
+
+def save_baseline(filename, topology, results):
+    f = open(filename, "w")
+    try:
+        json.dump({"version": baseline_version, "topology": topology, "results": results},
+                  f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-t", "--topology", default="",
+                      help="generated tree shape as name=value,..., defaults: %s" % (Topology()))
+    parser.add_option("-d", "--dir", help="generate the tree here and keep it, default is a temporary directory")
+    parser.add_option("--sysfs", help="benchmark an existing sysfs tree instead of generating one, no writes are done")
+    parser.add_option("-r", "--repeat", type="int", default=5, help="runs of each timing, the best is kept")
+    parser.add_option("-b", "--baseline", help="compare against the results saved in this file")
+    parser.add_option("-s", "--save", help="save the results to this file as a baseline")
+    parser.add_option("--tolerance", type="float", default=0.25,
+                      help="fraction over the baseline that counts as a regression")
+    options, args = parser.parse_args()
+
+    tmp = None
+    if options.sysfs is not None:
+        sysfs_root = options.sysfs
+        topology = "sysfs:%s" % (os.path.abspath(sysfs_root))
+        writes = False
+    else:
+        topology = str(Topology.parse(options.topology))
+        sysfs_root = options.dir
+        if sysfs_root is None:
+            tmp = sysfs_root = tempfile.mkdtemp()
+            os.rmdir(tmp)
+        generate(sysfs_root, Topology.parse(topology))
+        writes = True
+
+    try:
+        results = run(sysfs_root, options.repeat, writes=writes)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+    baseline = None
+    if options.baseline is not None:
+        saved = load_baseline(options.baseline)
+        if saved["topology"] != topology:
+            print "Warning: baseline was taken on %s, not %s" % (saved["topology"], topology)
+        baseline = saved["results"]
+
+    print "topology: %s" % (topology)
+    regressed = report(results, baseline, options.tolerance)
+    if options.save is not None:
+        save_baseline(options.save, topology, results)
+    if regressed:
+        print "%d regressions: %s" % (len(regressed), ", ".join(regressed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+"""
+Synthetic sysfs trees
+
+Writes a fake /sys holding a PCI hierarchy laid out by a Topology: root ports
+off each host bridge, PLX style switches fanning out below them and
+multi-function endpoints with SR-IOV VFs at the bottom.  Every function gets
+a 4096 byte config space with the capabilities its kind of device would have,
+its ID attribute files and a /sys/bus/pci/devices link, and the PFs and VFs
+the virtfnN and physfn links between them, so PCIDevices finds it like the
+real thing:
+
+    generate("/tmp/sys", Topology(root_ports=4, switch_ports=8, vfs=32))
+    dl = PCIDevices(sysfs_root="/tmp/sys")
+"""
+
+import os, struct, shutil
+from pcitweak.devices import PCIDeviceAddress
+
+# Left in the top of a generated tree, generate() only ever deletes a
+# directory holding one
+MARKER = ".pcitweak-synthetic"
+
+class Topology:
+    "Shape of a generated tree, the defaults come to a little over 2000 functions"
+
+    # (name, default) in the order they're shown
+    params = [
+        ("domains", 1),
+        # Per host bridge, at most 31
+        ("root_ports", 4),
+        # Switches stacked below each root port, 0 puts endpoints straight
+        # on the root ports
+        ("switch_depth", 1),
+        # Downstream ports per switch, at most 32
+        ("switch_ports", 8),
+        # Physical functions per endpoint, at most 8
+        ("functions", 2),
+        # VFs per physical function
+        ("vfs", 32),
+    ]
+
+    def __init__(self, **args):
+        for name, default in self.params:
+            value = args.pop(name, default)
+            if value < 0:
+                raise ValueError("Topology %s can't be negative" % (name))
+            setattr(self, name, value)
+        if args:
+            raise ValueError("Unknown topology parameters %s" % (", ".join(args.keys())))
+        if self.root_ports > 31 or self.switch_ports > 32 or self.functions > 8:
+            raise ValueError("Topology doesn't fit in the device/function numbers: %s" % (self))
+
+    @classmethod
+    def parse(cls, spec):
+        "From name=value,..., ex: root_ports=2,vfs=64"
+        args = {}
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            name, value = item.split("=", 1)
+            args[name.strip()] = int(value, 0)
+        return cls(**args)
+
+    def __str__(self):
+        return ",".join(["%s=%d" % (name, getattr(self, name)) for name, default in self.params])
+
+####################################################################
+#### Config space images
+####################################################################
+
+class ConfigImage:
+    "A config space under construction, capabilities are chained in the order they're added"
+    def __init__(self, vendor, device, class_code, header_type=0, size=4096):
+        self.data = bytearray(size)
+        # Memory space and bus master enabled, capability list present
+        self.pack("HHHH", 0x00, vendor, device, 0x0406, 0x0010)
+        self.pack("I", 0x08, (class_code << 8) | 0x01)
+        self.data[0x0e] = header_type
+        self.last_cap = None
+        self.next_cap = 0x40
+        self.last_ext_cap = None
+        self.next_ext_cap = 0x100
+
+    def pack(self, fmt, offset, *values):
+        struct.pack_into("<" + fmt, self.data, offset, *values)
+
+    def cap(self, id, length):
+        "Append a capability, returns its offset"
+        offset = self.next_cap
+        if offset + length > 0x100:
+            raise ValueError("Capabilities don't fit in the first 256 bytes")
+        if self.last_cap is None:
+            self.data[0x34] = offset
+        else:
+            self.data[self.last_cap + 1] = offset
+        self.data[offset] = id
+        self.last_cap = offset
+        self.next_cap = (offset + length + 3) & ~0x3
+        return offset
+
+    def ext_cap(self, id, version, length):
+        "Append an extended capability, returns its offset"
+        offset = self.next_ext_cap
+        if offset + length > len(self.data):
+            raise ValueError("Extended capabilities don't fit in the config space")
+        if self.last_ext_cap is not None:
+            header = struct.unpack_from("<I", self.data, self.last_ext_cap)[0]
+            self.pack("I", self.last_ext_cap, header | (offset << 20))
+        self.pack("I", offset, id | (version << 16))
+        self.last_ext_cap = offset
+        self.next_ext_cap = (offset + length + 3) & ~0x3
+        return offset
+
+    def bridge(self, primary, secondary, subordinate):
+        self.pack("BBBB", 0x18, primary, secondary, subordinate, 0)
+
+    def bar64(self, index, address):
+        "64 bit prefetchable memory BAR"
+        self.pack("II", 0x10 + index * 4, (address & 0xfffffff0) | 0xc, address >> 32)
+
+    def subsystem(self, vendor, device):
+        self.pack("HH", 0x2c, vendor, device)
+
+    def ids(self):
+        "(vendor, device)"
+        return struct.unpack_from("<HH", self.data, 0x00)
+
+    def tostring(self):
+        return str(self.data)
+
+# PCI Express Capabilities Register device/port types
+PCIE_ENDPOINT = 0x0
+PCIE_ROOT_PORT = 0x4
+PCIE_UPSTREAM = 0x5
+PCIE_DOWNSTREAM = 0x6
+
+def add_pm(img):
+    offset = img.cap(0x01, 0x08)
+    # Version 3, D1/D2 not supported, No_Soft_Reset
+    img.pack("HH", offset + 0x02, 0x0003, 0x0008)
+
+def add_msi(img, vectors=1):
+    offset = img.cap(0x05, 0x18)
+    mmc = 0
+    while (1 << mmc) < vectors:
+        mmc += 1
+    # 64 bit, per vector masking
+    img.pack("H", offset + 0x02, (1 << 8) | (1 << 7) | (mmc << 1))
+
+def add_msix(img, table_size):
+    offset = img.cap(0x11, 0x0c)
+    img.pack("HII", offset + 0x02, table_size - 1, 0x2000, 0x3000)
+
+def add_pcie(img, port_type, mps_supported, speed, width, port=0, slot=None):
+    offset = img.cap(0x10, 0x3c)
+    img.pack("H", offset + 0x02, 0x2 | (port_type << 4) | ((slot is not None) << 8))
+    devcap = mps_supported | (1 << 5) | (1 << 15)
+    if port_type == PCIE_ENDPOINT:
+        # L0s/L1 acceptable latency, function level reset
+        devcap |= (0x7 << 6) | (0x7 << 9) | (1 << 28)
+    img.pack("I", offset + 0x04, devcap)
+    # Relaxed ordering, extended tags, no snoop, MPS 128, MRRS 512
+    img.pack("H", offset + 0x08, 0x2810)
+
+    if speed:
+        # ASPM L0s/L1, exit latencies, DLL link active reporting on ports
+        linkcap = speed | (width << 4) | (0x3 << 10) | (0x2 << 12) | (0x6 << 15) | (port << 24)
+        if port_type in (PCIE_ROOT_PORT, PCIE_DOWNSTREAM):
+            linkcap |= 1 << 20
+        img.pack("IHH", offset + 0x0c, linkcap, 0x0040, speed | (width << 4) | (1 << 12))
+        img.pack("I", offset + 0x2c, ((1 << speed) - 1) << 1)
+        img.pack("H", offset + 0x30, speed)
+
+    if slot is not None:
+        # 25W, hot plug surprise/capable, presence detected
+        img.pack("IHH", offset + 0x14, (slot << 19) | (25 << 7) | (0x3 << 5), 0x0000, 0x0040)
+
+    # Completion timeout ranges, LTR, ARI forwarding on downstream facing ports
+    devcap2 = 0xf | (1 << 4) | (1 << 11)
+    if port_type in (PCIE_ROOT_PORT, PCIE_DOWNSTREAM):
+        devcap2 |= 1 << 5
+    img.pack("I", offset + 0x24, devcap2)
+
+def add_aer(img, root=False):
+    length = 0x38
+    if root:
+        length = 0x48
+    offset = img.ext_cap(0x0001, 2, length)
+    # Default severities, advisory non-fatal masked, ECRC generation capable
+    img.pack("I", offset + 0x0c, 0x00462030)
+    img.pack("II", offset + 0x14, 0x00002000, 0x000000a0)
+
+def add_dsn(img, serial):
+    offset = img.ext_cap(0x0003, 1, 0x0c)
+    img.pack("Q", offset + 0x04, serial)
+
+def add_acs(img):
+    offset = img.ext_cap(0x000d, 1, 0x08)
+    # Source validation, translation blocking, P2P request/completion
+    # redirect, upstream forwarding, enabled on all but translation blocking
+    img.pack("HH", offset + 0x04, 0x001f, 0x001d)
+
+def add_ari(img, next_function):
+    offset = img.ext_cap(0x000e, 1, 0x08)
+    img.pack("H", offset + 0x04, next_function << 8)
+
+def add_sriov(img, total, first_offset, stride, vf_device):
+    offset = img.ext_cap(0x0010, 1, 0x40)
+    control = 0
+    if total:
+        # VF enable, VF memory space enable
+        control = 0x0009
+    img.pack("HHHHH", offset + 0x08, control, 0, total, total, total)
+    img.pack("HH", offset + 0x14, first_offset, stride)
+    img.pack("H", offset + 0x1a, vf_device)
+    img.pack("II", offset + 0x1c, 0x553, 0x1)
+
+def add_ltr(img):
+    offset = img.ext_cap(0x0018, 1, 0x08)
+    img.pack("HH", offset + 0x04, 0x1003, 0x1003)
+
+def add_secondary_pcie(img, width):
+    # Lane equalization control, 2 bytes per lane
+    img.ext_cap(0x0019, 1, 0x0c + 2 * width)
+
+def add_l1ss(img):
+    offset = img.ext_cap(0x001e, 1, 0x10)
+    # PCI-PM and ASPM L1.1/L1.2, L1 PM substates
+    img.pack("I", offset + 0x04, 0x1f | (0x28 << 8) | (0x2 << 16) | (0x6 << 19))
+
+####################################################################
+#### Device kinds
+####################################################################
+
+# (vendor, PF device, VF device, class, max payload supported) of the
+# endpoints, used in turn
+endpoint_models = [
+    (0x15b3, 0x1017, 0x1018, 0x020000, 2),  # Mellanox ConnectX-5
+    (0x8086, 0x1572, 0x154c, 0x020000, 2),  # Intel X710
+    (0x14e4, 0x16d7, 0x16dc, 0x020000, 1),  # Broadcom BCM57414
+    (0x144d, 0xa824, 0xa824, 0x010802, 1),  # Samsung NVMe
+]
+
+def host_bridge_image():
+    img = ConfigImage(0x8086, 0x2020, 0x060000)
+    img.subsystem(0x8086, 0x0000)
+    img.cap(0x09, 0x0c)
+    add_pcie(img, 0x9, 0, 0, 0)
+    return img
+
+def port_image(port_type, primary, secondary, subordinate, device, serial):
+    "Root port or switch port"
+    if port_type == PCIE_ROOT_PORT:
+        img = ConfigImage(0x8086, 0x2030, 0x060400, 0x01)
+        mps, width = 1, 16
+    else:
+        img = ConfigImage(0x10b5, 0x8796, 0x060400, 0x01)
+        mps, width = 2, 16
+        if port_type == PCIE_DOWNSTREAM:
+            width = 8
+    img.bridge(primary, secondary, subordinate)
+    add_pm(img)
+    add_msi(img)
+    slot = None
+    if port_type != PCIE_UPSTREAM:
+        slot = (primary << 5) | device
+    add_pcie(img, port_type, mps, 3, width, device, slot)
+    add_aer(img, port_type == PCIE_ROOT_PORT)
+    if port_type == PCIE_UPSTREAM:
+        add_dsn(img, serial)
+        add_ltr(img)
+    else:
+        add_acs(img)
+    add_secondary_pcie(img, width)
+    if port_type != PCIE_UPSTREAM:
+        add_l1ss(img)
+    return img
+
+def pf_image(model, function, functions, vfs, serial):
+    vendor, device, vf_device, class_code, mps = model
+    header_type = 0x00
+    if functions > 1:
+        header_type = 0x80
+    img = ConfigImage(vendor, device, class_code, header_type)
+    img.bar64(0, 0x38000000000 + (serial & 0xffff) * 0x2000000)
+    img.subsystem(vendor, 0x0001)
+    add_pm(img)
+    add_msi(img, 8)
+    add_pcie(img, PCIE_ENDPOINT, mps, 3, 8)
+    add_msix(img, 64)
+    add_aer(img)
+    add_dsn(img, serial)
+    next_function = 0
+    if function + 1 < functions:
+        next_function = function + 1
+    add_ari(img, next_function)
+    if vfs:
+        # VFs of every PF follow the PFs, in PF order
+        add_sriov(img, vfs, functions - function + function * vfs, 1, vf_device)
+    add_ltr(img)
+    add_secondary_pcie(img, 8)
+    add_l1ss(img)
+    return img
+
+def vf_image(model):
+    vendor, device, vf_device, class_code, mps = model
+    # VFs read back all ones for their IDs, sysfs has the real ones
+    img = ConfigImage(0xffff, 0xffff, class_code)
+    img.subsystem(vendor, 0x0001)
+    add_pcie(img, PCIE_ENDPOINT, mps, 0, 0)
+    add_msix(img, 8)
+    add_ari(img, 0)
+    return img
+
+####################################################################
+#### Trees
+####################################################################
+
+class TreeWriter:
+    def __init__(self, root, topology):
+        self.root = root
+        self.topology = topology
+        self.bus_dir = os.path.join(root, "bus", "pci", "devices")
+        self.endpoints = 0
+        self.serial = 0x0011223300000000
+        # Number of functions written
+        self.count = 0
+
+    def _next_serial(self):
+        self.serial += 1
+        return self.serial
+
+    def _mkdir(self, parent_dir, addr):
+        dev_dir = os.path.join(parent_dir, str(addr))
+        os.mkdir(dev_dir)
+        os.symlink(os.path.relpath(dev_dir, self.bus_dir), os.path.join(self.bus_dir, str(addr)))
+        return dev_dir
+
+    def _write(self, dev_dir, img, ids):
+        "Config file and the ID attributes, ids is (vendor, device, sub vendor, sub device, class)"
+        f = open(os.path.join(dev_dir, "config"), "wb")
+        try:
+            f.write(img.tostring())
+        finally:
+            f.close()
+        for name, value in zip(("vendor", "device", "subsystem_vendor", "subsystem_device"), ids):
+            f = open(os.path.join(dev_dir, name), "w")
+            try:
+                f.write("0x%04x\n" % (value))
+            finally:
+                f.close()
+        f = open(os.path.join(dev_dir, "class"), "w")
+        try:
+            f.write("0x%06x\n" % (ids[4]))
+        finally:
+            f.close()
+        self.count += 1
+
+    def write(self):
+        devices_dir = os.path.join(self.root, "devices")
+        os.makedirs(devices_dir)
+        os.makedirs(self.bus_dir)
+        for domain in range(self.topology.domains):
+            top = os.path.join(devices_dir, "pci%04x:00" % (domain))
+            os.mkdir(top)
+            self._write(self._mkdir(top, PCIDeviceAddress(domain, 0, 0, 0)), host_bridge_image(),
+                        (0x8086, 0x2020, 0x8086, 0x0000, 0x060000))
+            bus = 0
+            for port in range(self.topology.root_ports):
+                addr = PCIDeviceAddress(domain, 0, port + 1, 0)
+                bus = self.port(top, addr, PCIE_ROOT_PORT, bus + 1, self.topology.switch_depth)
+
+    def port(self, parent_dir, addr, port_type, secondary, depth):
+        "Write a bridge and everything below it, returns its subordinate bus"
+        if secondary > 0xff:
+            raise ValueError("Topology needs more than 256 buses in a domain")
+        dev_dir = self._mkdir(parent_dir, addr)
+        if port_type == PCIE_UPSTREAM:
+            subordinate = secondary
+            bus = secondary
+            for port in range(self.topology.switch_ports):
+                below = PCIDeviceAddress(addr.domain, secondary, port, 0)
+                subordinate = self.port(dev_dir, below, PCIE_DOWNSTREAM, bus + 1, depth - 1)
+                bus = subordinate
+        elif depth > 0:
+            below = PCIDeviceAddress(addr.domain, secondary, 0, 0)
+            subordinate = self.port(dev_dir, below, PCIE_UPSTREAM, secondary + 1, depth)
+        else:
+            subordinate = self.endpoint(dev_dir, addr.domain, secondary)
+
+        img = port_image(port_type, addr.bus, secondary, subordinate, addr.device, self._next_serial())
+        vendor, device = img.ids()
+        self._write(dev_dir, img, (vendor, device, 0, 0, 0x060400))
+        return subordinate
+
+    def endpoint(self, parent_dir, domain, bus):
+        "Write the functions of one endpoint and their VFs, returns the last bus they use"
+        model = endpoint_models[self.endpoints % len(endpoint_models)]
+        self.endpoints += 1
+        vendor, device, vf_device, class_code, mps = model
+        functions = self.topology.functions
+        vfs = self.topology.vfs
+        last_bus = bus
+        for function in range(functions):
+            addr = PCIDeviceAddress(domain, bus, 0, function)
+            pf_dir = self._mkdir(parent_dir, addr)
+            self._write(pf_dir, pf_image(model, function, functions, vfs, self._next_serial()),
+                        (vendor, device, vendor, 0x0001, class_code))
+
+            # ARI routing IDs, the VFs can spill over onto the next buses
+            for vf in range(vfs):
+                rid = functions + function * vfs + vf
+                last_bus = bus + rid / 256
+                if last_bus > 0xff:
+                    raise ValueError("Topology needs more than 256 buses in a domain")
+                addr = PCIDeviceAddress(domain, last_bus, (rid % 256) >> 3, rid & 0x7)
+                vf_dir = self._mkdir(parent_dir, addr)
+                self._write(vf_dir, vf_image(model), (vendor, vf_device, vendor, 0x0001, class_code))
+                # Links between the PF and its VFs, as sysfs has them
+                os.symlink(os.path.join("..", str(addr)), os.path.join(pf_dir, "virtfn%d" % (vf)))
+                os.symlink(os.path.join("..", os.path.basename(pf_dir)), os.path.join(vf_dir, "physfn"))
+        return last_bus
+
+def generate(root, topology=None):
+    """
+    Write a tree for topology (the default Topology if None) under root,
+    replacing an earlier generated tree there.  Returns the number of
+    functions written.
+    """
+    if topology is None:
+        topology = Topology()
+    if os.path.exists(root):
+        if not os.path.exists(os.path.join(root, MARKER)):
+            raise RuntimeError("%s exists and isn't a generated tree, not replacing it" % (root))
+        shutil.rmtree(root)
+    os.makedirs(root)
+    f = open(os.path.join(root, MARKER), "w")
+    try:
+        f.write("%s\n" % (topology))
+    finally:
+        f.close()
+
+    writer = TreeWriter(root, topology)
+    writer.write()
+    return writer.count
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+
+# Save every device's config space before tuning (check_all.py and friends)
+# and roll the control registers back to it afterwards
+#
+#   baseline.py save baseline.pcia
+#   baseline.py diff baseline.pcia
+#   baseline.py restore baseline.pcia
+
+from pcitweak.devices import PCIDevices
+from pcitweak.archive import PCIArchiveDevices, restore_plan
+from pcitweak.diff import diff_devices
+from pcitweak.tuning import apply_plan
+
+import os, sys
+
+def baseline(cmd, filename):
+    dl = PCIDevices(lazy=True, snapshot=True)
+    if cmd == "save":
+        dl.save(filename)
+        print "Saved %d devices to %s" % (len(dl.devices), filename)
+        return
+
+    saved = PCIArchiveDevices(filename)
+    try:
+        if cmd == "diff":
+            changes = diff_devices(saved, dl)
+            for addr in sorted(changes):
+                for change in changes[addr]:
+                    print "DIFF: %s %s" % (addr, change)
+            return
+
+        plan = restore_plan(saved, dl)
+        for change in plan:
+            print "RESTORE: %s" % (change)
+        apply_plan(plan)
+    finally:
+        saved.close()
+
+if len(sys.argv) != 3 or sys.argv[1] not in ["save", "diff", "restore"]:
+    print "usage: %s save|diff|restore <archive>" % (sys.argv[0])
+    sys.exit(1)
+baseline(sys.argv[1], sys.argv[2])
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 from pcitweak.devices import PCIDevices, PCIDeviceAddress
+from pcitweak.tuning import Tuner, default_rules, phantom_functions_rule
 
 import os, sys
 
@@ -20,59 +21,6 @@ def check_power(dev, at_least_watts=25):
 
     print
 
-def check_maxpayload(check_dev, dl):
-    print "Checking Max Payload setting"
-    bytes_size = [ 128, 256, 512, 1024, 2048, 4096 ]
-    dev_index = 0
-    for dev in dl.walk_from_root(check_dev):
-        try:
-            maxpayload_s = dev.config.read("pcie_device_capabilities_max_payload_size_supported")
-        except:
-            print "WARNING: Could not get maxpayload supported for %s" % (dev.addr)
-            continue
-        try:
-            maxpayload_c = dev.config.read("pcie_device_control_max_payload_size")
-        except:
-            print "WARNING: Could not get maxpayload setting for %s" % (dev.addr)
-            continue
-
-        indent = "  " * dev_index
-        msg = "%s%s " % (indent, dev.addr)
-        print msg
-
-        print "%s  MaxPayload supported %d" % (indent, bytes_size[maxpayload_s])
-        print "%s  MaxPayload configured %d" % (indent, bytes_size[maxpayload_c])
-        if maxpayload_c != maxpayload_s:
-            print "%s  TUNING: Setting MaxPayload to %d" % (indent, bytes_size[maxpayload_s])
-            dev.config.write("pcie_device_control_max_payload_size", maxpayload_s)
-        dev_index += 1
-        print
-    print
-
-def check_maxreadreq(check_dev, dl):
-    print "Checking Max Read Request setting"
-    bytes_size = [ 128, 256, 512, 1024, 2048, 4096 ]
-    MAXREADREQ = 4096
-    dev_index = 0
-    for dev in dl.walk_from_root(check_dev):
-        try:
-            maxreadreq = dev.config.read("pcie_device_control_max_read_request_size")
-        except:
-            print "WARNING: Could not get max readreq setting for %s" % (dev.addr)
-            continue
-
-        indent = "  " * dev_index
-        msg = "%s%s " % (indent, dev.addr)
-        print msg
-
-        print "%s  MaxReadReq %d" % (indent, bytes_size[maxreadreq])
-        if bytes_size[maxreadreq] != MAXREADREQ:
-            print "%s  TUNING: Setting MaxReadReq to %d" % (indent, MAXREADREQ)
-            dev.config.write("pcie_device_control_max_read_request_size", bytes_size.index(MAXREADREQ))
-        dev_index += 1
-        print
-    print
-
 def check_errors(dev):
     print "Checking error flags"
     corr = dev.config.read("pcie_device_status_correctable_error_detected")
@@ -94,35 +42,24 @@ def check_errors(dev):
         dev.config.write("pcie_device_status_unsupported_request_error_detected", 1)
     print
 
-def check_phantom(dev):
-    cap = dev.config.read("pcie_device_capabilities_phantom_functions_supported")
-    stat = dev.config.read("pcie_device_control_phantom_functions_enable")
-    print "Checking phantom funcs setting, currently %d" % (stat)
-    if cap != stat:
-        print "TUNING: Phantom Funcs supported is %d but setting is %d, updating to supported value" % (cap, stat)
-        dev.config.write("pcie_device_control_phantom_functions_enable", 1)
-    print
-
-def check_tag(dev):
-    cap = dev.config.read("pcie_device_capabilities_extended_tag_field_supported")
-    stat = dev.config.read("pcie_device_control_extended_tag_field_enable")
-    print "Checking extended tag support, currently %d" % (stat)
-    if cap != stat:
-        print "TUNING: Extended tag supported is %d but setting is %d, updating to supported value" % (cap, stat)
-        dev.config.write("pcie_device_control_tag_field_enable", 1)
+def tune(dl, check_devs):
+    print "### Tuning"
+    tuner = Tuner(dl, default_rules + [phantom_functions_rule])
+    plan = tuner.plan(select=check_devs)
+    for change in plan:
+        print "TUNING: %s" % (change)
+    tuner.apply(plan)
     print
 
 def select_devices():
-    dl = PCIDevices()
+    dl = PCIDevices(lazy=True, snapshot=True)
+    check_devs = []
     for vendor in [FUSION_VENDOR, MELLANOX_VENDOR]:
-        check_devs = dl.get(vendor=vendor)
-        for check_dev in check_devs:
-            print "### Checking device %s" % (check_dev.addr)
-            check_power(check_dev)
-            check_maxpayload(check_dev, dl)
-            check_maxreadreq(check_dev, dl)
-            check_errors(check_dev)
-            check_phantom(check_dev)
-            check_tag(check_dev)
+        check_devs.extend(dl.get(vendor=vendor))
+    for check_dev in check_devs:
+        print "### Checking device %s" % (str(check_dev.addr))
+        check_power(check_dev)
+        check_errors(check_dev)
+    tune(dl, check_devs)
 
 select_devices()
@@ -17,11 +17,11 @@ FUSION_IODIMM_GEN1=0x1005
 def kill_dev():
     bytes_size = [ 128, 256, 512, 1024, 2048, 4096 ]
 
-    dl = PCIDevices()
+    dl = PCIDevices(lazy=True)
 
     fusion_devs = dl.get(device=FUSION_IODIMM_GEN1)
     # Try to get fioa to kill
-    fusion_devs.sort(key=lambda m: str(m.addr))
+    fusion_devs.sort(key=lambda m: m.addr)
 
     kill_dimm = fusion_devs[0]
     print ""
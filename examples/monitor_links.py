@@ -0,0 +1,32 @@
+#!/usr/bin/python
+
+# Watch link speed/width and error status of the Fusion and Mellanox devices,
+# printing a CSV line per device every second.  Runs until killed, use this
+# instead of running check_all.py from cron.
+
+from pcitweak.devices import PCIDevices
+from pcitweak.monitor import Monitor, default_fields
+
+import os, sys
+
+FUSION_VENDOR=0x1aed
+MELLANOX_VENDOR=0x15b3
+
+def monitor_links():
+    dl = PCIDevices(lazy=True)
+    check_devs = []
+    for vendor in [FUSION_VENDOR, MELLANOX_VENDOR]:
+        check_devs.extend(dl.get(vendor=vendor))
+
+    mon = Monitor(dl, check_devs)
+    print "time,addr," + ",".join(default_fields)
+    for sample in mon.samples(interval=1.0):
+        if sample.error is not None:
+            print "%.3f,%s,ERROR: %s" % (sample.time, sample.addr, sample.error)
+            sys.stdout.flush()
+            continue
+        values = [str(sample.values.get(field, "")) for field in default_fields]
+        print "%.3f,%s,%s" % (sample.time, sample.addr, ",".join(values))
+        sys.stdout.flush()
+
+monitor_links()
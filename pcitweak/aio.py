@@ -0,0 +1,185 @@
+"""
+asyncio facade
+
+Runs config space I/O on a bounded pool of threads so an event loop never
+blocks on sysfs.  Calls for one device run one at a time in the order they
+were made, different devices run in parallel.  Works with asyncio or, on
+python 2, trollius:
+
+    adl = AsyncPCIDevices(PCIDevices(lazy=True))
+
+    @asyncio.coroutine
+    def widths():
+        devs = adl.get(vendor=0x15b3)
+        width = yield From(devs[0].config.aread("pcie_link_status_negotiated_link_width"))
+        yield From(devs[0].config.awrite("pcie_device_control_max_read_request_size", 5))
+        everything = yield From(adl.gather_read(devs, ["pcie_link_status_link_speed",
+                                                      "pcie_link_status_negotiated_link_width"]))
+"""
+
+import threading, collections
+from multiprocessing.pool import ThreadPool
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+class DeviceQueue:
+    "Pending calls for one device"
+    def __init__(self):
+        self.calls = collections.deque()
+        self.running = False
+
+class AsyncPCIConfig:
+    "Awaitable config space access for one device, see AsyncPCIDevices"
+    def __init__(self, adevices, dev):
+        self.adevices = adevices
+        self.dev = dev
+
+    def _read(self, name):
+        return self.dev.config.read(name)
+
+    def _read_many(self, names):
+        ret = {}
+        for name in names:
+            ret[name] = self.dev.config.read(name)
+        return ret
+
+    def _write(self, name, value):
+        self.dev.config.write(name, value)
+
+    def _batch(self, values):
+        batch = self.dev.config.batch()
+        for name, value in values:
+            batch.write(name, value)
+        batch.commit()
+
+    def aread(self, name):
+        return self.adevices.submit(self.dev, self._read, name)
+
+    def aread_many(self, names):
+        "{name: value} for all of names from one trip to the pool"
+        return self.adevices.submit(self.dev, self._read_many, names)
+
+    def awrite(self, name, value):
+        return self.adevices.submit(self.dev, self._write, name, value)
+
+    def awrite_batch(self, values):
+        "Write (name, value) pairs as one ConfigWriteBatch"
+        return self.adevices.submit(self.dev, self._batch, values)
+
+class AsyncPCIDevice:
+    "A PCIDevice whose config does its I/O off the event loop"
+    def __init__(self, adevices, dev):
+        self.dev = dev
+        self.config = AsyncPCIConfig(adevices, dev)
+
+    def __getattr__(self, name):
+        return getattr(self.dev, name)
+
+class AsyncPCIDevices:
+    def __init__(self, devices, threads=8, loop=None):
+        """
+        devices: the PCIDevices to wrap, build it with lazy=True so parsing
+                 each config space also happens on the pool
+        threads: most config accesses in flight at once
+        loop:    event loop futures are resolved on, defaults to the current
+        """
+        if asyncio is None:
+            raise RuntimeError("AsyncPCIDevices needs asyncio or trollius")
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.devices = devices
+        self.loop = loop
+        self.pool = ThreadPool(threads)
+        self.lock = threading.Lock()
+        # addr -> DeviceQueue
+        self.queues = {}
+        # addr -> AsyncPCIDevice
+        self.wrapped = {}
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def wrap(self, dev):
+        if isinstance(dev, AsyncPCIDevice):
+            return dev
+        ret = self.wrapped.get(dev.addr)
+        if ret is None or ret.dev is not dev:
+            ret = self.wrapped[dev.addr] = AsyncPCIDevice(self, dev)
+        return ret
+
+    def get(self, **args):
+        "PCIDevices.get(), as AsyncPCIDevices"
+        return [self.wrap(dev) for dev in self.devices.get(**args)]
+
+    def submit(self, dev, fn, *args):
+        """
+        Future for fn(*args), run on the pool once everything submitted for
+        dev before it is done
+        """
+        if isinstance(dev, AsyncPCIDevice):
+            dev = dev.dev
+        future = asyncio.Future(loop=self.loop)
+        self.lock.acquire()
+        try:
+            queue = self.queues.get(dev.addr)
+            if queue is None:
+                queue = self.queues[dev.addr] = DeviceQueue()
+            queue.calls.append((future, fn, args))
+            if queue.running:
+                return future
+            queue.running = True
+        finally:
+            self.lock.release()
+        self.pool.apply_async(self._run_next, (queue,))
+        return future
+
+    def _run_next(self, queue):
+        "Run a device's oldest call, then give the thread up before the next"
+        self.lock.acquire()
+        try:
+            future, fn, args = queue.calls.popleft()
+        finally:
+            self.lock.release()
+
+        try:
+            result = fn(*args)
+        except Exception, e:
+            self.loop.call_soon_threadsafe(self._resolve, future, None, e)
+        else:
+            self.loop.call_soon_threadsafe(self._resolve, future, result, None)
+
+        self.lock.acquire()
+        try:
+            if not queue.calls:
+                queue.running = False
+                return
+        finally:
+            self.lock.release()
+        self.pool.apply_async(self._run_next, (queue,))
+
+    def _resolve(self, future, result, exception):
+        if future.cancelled():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def gather_read(self, devs, names):
+        """
+        Future for a list with {name: value} for each of devs, in order, read
+        in parallel across devices
+        """
+        futures = [self.wrap(dev).config.aread_many(names) for dev in devs]
+        if not futures:
+            future = asyncio.Future(loop=self.loop)
+            future.set_result([])
+            return future
+        return asyncio.gather(*futures)
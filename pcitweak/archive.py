@@ -0,0 +1,217 @@
+"""
+Config space archives
+
+One file holds the raw config space of every device: a header, an index with
+one fixed size entry per function, then the 256 or 4096 byte images.
+
+    PCIDevices(lazy=True).save("baseline.pcia")
+    ... tune ...
+    saved = PCIArchiveDevices("baseline.pcia")
+    try:
+        apply_plan(restore_plan(saved, PCIDevices(lazy=True)))
+    finally:
+        saved.close()
+
+Loading mmaps the file and only parses the index, each device's config space
+is parsed from the mapping the first time it's used.  The mapping stays until
+close(), or the end of a with block.
+"""
+
+import mmap, struct
+from config import PCIConfigSpaceAccess, BufferConfigBackend
+from devices import PCIDevices, PCIDevice, PCIDeviceAddress
+
+ARCHIVE_MAGIC = "PCITWEAK"
+ARCHIVE_VERSION = 1
+
+# magic, version, index entry size, entry count
+archive_header = struct.Struct("<8sHHI")
+# addr, parent addr, image offset, image length, vendor, device, sub vendor,
+# sub device, class code, flags
+archive_entry = struct.Struct("<IIIIHHHHII")
+
+FLAG_ROOT = 0x1
+FLAG_PARENT = 0x2
+# Listed in the parent's children, devices directly under a root complex
+# only point at the root
+FLAG_CHILD = 0x4
+FLAG_SUBSYSTEM = 0x8
+
+def save_archive(devices, filename):
+    "Write every device in devices to filename, one read of each config space"
+    index = []
+    images = []
+    offset = archive_header.size + archive_entry.size * len(devices.devices)
+    for dev in devices.devices:
+        image = ""
+        if dev.config is not None:
+            access = dev.config.config
+            image = access.read_block(0, access.size())
+
+        flags = 0
+        parent = 0
+        if dev.is_root:
+            flags |= FLAG_ROOT
+        if dev.parent is not None:
+            flags |= FLAG_PARENT
+            parent = dev.parent.addr.bdf
+            if dev in dev.parent.children:
+                flags |= FLAG_CHILD
+        sub_vendor = sub_device = 0
+        if dev.sub_vendor is not None:
+            flags |= FLAG_SUBSYSTEM
+            sub_vendor, sub_device = dev.sub_vendor, dev.sub_device
+
+        index.append(archive_entry.pack(dev.addr.bdf, parent, offset, len(image),
+                                        dev.vendor, dev.device, sub_vendor, sub_device,
+                                        dev.class_code, flags))
+        images.append(image)
+        offset += len(image)
+
+    f = open(filename, 'wb')
+    try:
+        f.write(archive_header.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, archive_entry.size, len(index)))
+        f.write("".join(index))
+        f.write("".join(images))
+    finally:
+        f.close()
+
+class PCIArchiveDevices(PCIDevices):
+    """
+    Read only PCIDevices for the devices saved in an archive, config space
+    reads come straight from the mapped file and writes raise IOError
+    """
+    def __init__(self, filename, snapshot=False):
+        self.filename = filename
+        # addr -> (offset, length) of the device's image
+        self.images = {}
+        self.mm = None
+        PCIDevices.__init__(self, snapshot=snapshot, lazy=True)
+
+    def close(self):
+        "Close the devices and unmap the archive"
+        PCIDevices.close(self)
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def discover(self):
+        f = open(self.filename, 'rb')
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        magic, version, entry_size, count = archive_header.unpack_from(self.mm, 0)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            raise RuntimeError("%s is not a version %d pcitweak archive" % (self.filename, ARCHIVE_VERSION))
+
+        byaddr = {}
+        links = []
+        for i in range(count):
+            (addr, parent, offset, length, vendor, device, sub_vendor, sub_device,
+             class_code, flags) = archive_entry.unpack_from(self.mm, archive_header.size + i * entry_size)
+
+            dev = PCIDevice(devices_parent=self)
+            dev.addr = PCIDeviceAddress.from_bdf(addr)
+            dev.vendor = vendor
+            dev.device = device
+            if flags & FLAG_SUBSYSTEM:
+                dev.sub_vendor = sub_vendor
+                dev.sub_device = sub_device
+            dev.class_code = class_code
+            dev.is_root = bool(flags & FLAG_ROOT)
+            if length:
+                self.images[dev.addr] = (offset, length)
+                dev._config_pending = True
+
+            self.devices.append(dev)
+            self._index_add(dev)
+            byaddr[addr] = dev
+            if not flags & FLAG_PARENT:
+                parent = None
+            links.append((parent, bool(flags & FLAG_CHILD)))
+
+        self._load__link(byaddr, links)
+
+    def _open_access(self, dev):
+        if self.mm is None:
+            raise RuntimeError("Archive %s is closed" % (self.filename))
+        offset, length = self.images[dev.addr]
+        backend = BufferConfigBackend(self.mm, offset, length)
+        return PCIConfigSpaceAccess(None, dev, self.snapshot, backend)
+
+    def read_image(self, dev):
+        if self.mm is None:
+            raise RuntimeError("Archive %s is closed" % (self.filename))
+        offset, length = self.images[dev.addr]
+        return self.mm[offset:offset + length]
+
+####################################################################
+#### Restore
+####################################################################
+
+# Control registers a restore puts back, status and capability registers are
+# either read only or write 1 to clear so they're left alone
+restore_regs = [
+    "common_command",
+    "type1_bridge_control",
+    "pcie_device_control",
+    "pcie_link_control",
+    "pcie_root_control",
+    "pcie_device2_control",
+    "pcie_link2_control",
+    "aer_uncorrectable_error_mask",
+    "aer_uncorrectable_error_severity",
+    "aer_correctable_error_mask",
+    "aer_capabilities_and_control",
+    "aer_root_error_command",
+    "acs_control",
+    "l1ss_control1",
+    "l1ss_control2",
+]
+
+class RestoreChange:
+    def __init__(self, dev, reg, current, value):
+        self.dev = dev
+        self.reg = reg
+        self.current = current
+        self.value = value
+
+    def __str__(self):
+        return "%s %s = 0x%x -> 0x%x" % (self.dev.addr, self.reg, self.current, self.value)
+
+def restore_plan(saved, devices, regs=None):
+    """
+    Changes that put the control registers of devices back to what they are
+    in saved (a PCIArchiveDevices), parents before children.  Devices that
+    aren't in saved, or have different IDs, are skipped.  Apply it with
+    tuning.apply_plan().
+    """
+    if regs is None:
+        regs = restore_regs
+
+    order = devices.roots()
+    for top in devices.hierarchies():
+        order.extend(devices.walk_subtree(top))
+
+    plan = []
+    for dev in order:
+        old = saved.get(addr=dev.addr)
+        if not old:
+            continue
+        old = old[0]
+        if (old.vendor, old.device) != (dev.vendor, dev.device):
+            print "Warning: %s is %04x:%04x, was %04x:%04x when saved, skipping" % (dev.addr, dev.vendor, dev.device, old.vendor, old.device)
+            continue
+        if old.config is None or dev.config is None:
+            continue
+
+        for reg in regs:
+            if reg not in old.config or reg not in dev.config:
+                continue
+            value = old.config.read(reg)
+            current = dev.config.read(reg)
+            if value != current:
+                plan.append(RestoreChange(dev, reg, current, value))
+    return plan
@@ -0,0 +1,100 @@
+"""
+Batch decoding of config dump corpora
+
+Decoding is pure python and CPU bound, so a corpus is spread over a pool of
+processes, one dump (host) per task.  Each dump is decoded into compact
+DeviceRecords and the results are streamed back as workers finish them:
+
+    for result in decode_corpus(glob.glob("dumps/*"), processes=16):
+        if result.error is not None:
+            print result.source, result.error
+            continue
+        for record in result.records:
+            print record.addr, record.fields
+
+A dump is anything open_dump() understands: an archive from
+PCIDevices.save(), a directory of config space images or lspci -xxxx output.
+"""
+
+import os, collections, multiprocessing, traceback
+from archive import PCIArchiveDevices, ARCHIVE_MAGIC
+from offline import PCIOfflineDevices
+
+DeviceRecord = collections.namedtuple("DeviceRecord", [
+    "addr", "vendor", "device", "sub_vendor", "sub_device", "class_code",
+    # (capability id, offset) in chain order
+    "caps", "ext_caps",
+    # {field: value} for the requested fields the device has
+    "fields"])
+
+CorpusResult = collections.namedtuple("CorpusResult", ["source", "records", "error"])
+
+default_record_fields = [
+    "pcie_link_status_link_speed",
+    "pcie_link_status_negotiated_link_width",
+    "pcie_device_capabilities_max_payload_size_supported",
+    "pcie_device_control_max_payload_size",
+    "pcie_device_control_max_read_request_size",
+]
+
+def open_dump(path):
+    "PCIDevices for a saved archive, a directory of images or an lspci dump"
+    if os.path.isdir(path):
+        return PCIOfflineDevices.from_directory(path)
+    f = open(path, 'rb')
+    try:
+        magic = f.read(len(ARCHIVE_MAGIC))
+    finally:
+        f.close()
+    if magic == ARCHIVE_MAGIC:
+        return PCIArchiveDevices(path)
+    return PCIOfflineDevices.from_lspci(path)
+
+def decode_dump(path, fields=None):
+    "DeviceRecord for every device in the dump at path"
+    if fields is None:
+        fields = default_record_fields
+    records = []
+    devices = open_dump(path)
+    try:
+        for dev in devices.devices:
+            config = dev.config
+            caps = ext_caps = ()
+            values = {}
+            if config is not None:
+                caps = tuple(config.caps)
+                ext_caps = tuple(config.ext_caps)
+                for name in fields:
+                    if name in config:
+                        values[name] = config.read(name)
+            records.append(DeviceRecord(dev.addr, dev.vendor, dev.device, dev.sub_vendor,
+                                        dev.sub_device, dev.class_code, caps, ext_caps, values))
+    finally:
+        # Workers go through many dumps, don't keep the last one mapped
+        devices.close()
+    return records
+
+def _decode_worker(args):
+    path, fields = args
+    try:
+        return CorpusResult(path, decode_dump(path, fields), None)
+    except Exception:
+        # One bad dump shouldn't take the whole run down
+        return CorpusResult(path, None, traceback.format_exc())
+
+def decode_corpus(paths, fields=None, processes=None, chunksize=1, maxtasksperchild=64):
+    """
+    Decode every dump in paths on a pool of processes (one per core by
+    default), yielding a CorpusResult per dump in the order they finish.
+    Each worker is replaced after maxtasksperchild dumps, so one fed a big
+    corpus doesn't keep growing.
+    """
+    pool = multiprocessing.Pool(processes, maxtasksperchild=maxtasksperchild)
+    try:
+        for result in pool.imap_unordered(_decode_worker, [(path, fields) for path in paths], chunksize):
+            yield result
+        pool.close()
+    finally:
+        # Stopped early or failed, don't leave the workers decoding
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,172 @@
+"""
+Columnar config space
+
+Stacks the config space of N devices into an (N, 4096) uint8 matrix and
+evaluates a register field for all of them at once instead of looping over
+ConfigRegSet.read():
+
+    m = ConfigMatrix.from_devices(PCIOfflineDevices.from_directory("host1/"))
+    width = m.field("pcie_link_status_negotiated_link_width")
+    mps = m.field("pcie_device_control_max_payload_size")
+
+Fields come back as numpy masked arrays, rows of devices that don't have the
+register (no such capability, wrong header type) are masked.  Capability
+offsets differ per device so those fields are a per row gather.
+
+Needs numpy.
+"""
+
+from config import ConfigPCICommon, ConfigPCIType0, ConfigPCIType1, cap_types, ext_cap_types
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CONFIG_SPACE_SIZE = 4096
+
+# Where a register lives: the common header, one of the header types or a
+# capability, see field_locations()
+LOC_COMMON = 0
+LOC_TYPE0 = 1
+LOC_TYPE1 = 2
+LOC_CAP = 3
+LOC_EXT_CAP = 4
+
+field_locations_cache = {}
+
+def field_locations():
+    "register name -> (ConfigReg, location, capability id)"
+    if field_locations_cache:
+        return field_locations_cache
+
+    sets = [(ConfigPCICommon(None), LOC_COMMON, None),
+            (ConfigPCIType0(None), LOC_TYPE0, None),
+            (ConfigPCIType1(None), LOC_TYPE1, None)]
+    for id, cap_type in cap_types.iteritems():
+        sets.append((cap_type(0, None), LOC_CAP, id))
+    for id, cap_type in ext_cap_types.iteritems():
+        sets.append((cap_type(0, None), LOC_EXT_CAP, id))
+
+    for regset, location, id in sets:
+        for reg in regset.regs:
+            field_locations_cache[reg.name] = (reg, location, id)
+    return field_locations_cache
+
+class ConfigMatrix:
+    def __init__(self, images, addrs=None):
+        """
+        images: raw config space of each device, anything shorter than 4096
+                bytes reads as zero past its end
+        addrs:  optional label for each row
+        """
+        if numpy is None:
+            raise RuntimeError("ConfigMatrix needs numpy")
+
+        self.addrs = addrs
+        self.data = numpy.zeros((len(images), CONFIG_SPACE_SIZE), numpy.uint8)
+        self.lengths = numpy.zeros(len(images), numpy.int32)
+        for row, image in enumerate(images):
+            image = image[:CONFIG_SPACE_SIZE]
+            self.data[row, :len(image)] = numpy.frombuffer(image, numpy.uint8)
+            self.lengths[row] = len(image)
+        self.rows = numpy.arange(len(images))
+        # (capability id, extended) -> per row offset, -1 where missing
+        self.cap_offsets = {}
+
+    @classmethod
+    def from_devices(cls, devices):
+        """
+        One row per device with a config space, in devices.devices order.
+        The images come from PCIDevices.read_image(), lazily discovered
+        devices don't get their config space parsed.
+        """
+        images = []
+        addrs = []
+        for dev in devices.devices:
+            image = devices.read_image(dev)
+            if image is None:
+                continue
+            images.append(image)
+            addrs.append(dev.addr)
+        return cls(images, addrs)
+
+    def __len__(self):
+        return len(self.data)
+
+    def gather(self, offsets, length):
+        "The length bit little endian value at offsets[row] in each row"
+        offsets = numpy.clip(offsets, 0, CONFIG_SPACE_SIZE - length / 8)
+        value = numpy.zeros(len(self.data), numpy.uint32)
+        for byte in range(length / 8):
+            value |= self.data[self.rows, offsets + byte].astype(numpy.uint32) << (8 * byte)
+        return value
+
+    def _walk_caps(self, id):
+        "Same walk as scan_capabilities(), one step of every row at a time"
+        found = numpy.full(len(self.data), -1, numpy.int32)
+        offset = (self.data[:, 0x34] & 0xfc).astype(numpy.int32)
+        active = (offset >= 0x40) & (offset < 0x100) & (offset + 2 <= self.lengths)
+        # 48 capabilities at most fit between 0x40 and 0x100
+        for step in range(48):
+            if not active.any():
+                break
+            hit = active & (self.data[self.rows, offset] == id)
+            found[hit] = offset[hit]
+            active &= ~hit
+            offset = (self.data[self.rows, numpy.minimum(offset + 1, 0xff)] & 0xfc).astype(numpy.int32)
+            active &= (offset >= 0x40) & (offset < 0x100) & (offset + 2 <= self.lengths)
+        return found
+
+    def _walk_ext_caps(self, id):
+        found = numpy.full(len(self.data), -1, numpy.int32)
+        offset = numpy.full(len(self.data), 0x100, numpy.int32)
+        active = self.lengths >= 0x104
+        for step in range((CONFIG_SPACE_SIZE - 0x100) / 4):
+            if not active.any():
+                break
+            header = self.gather(offset, 32)
+            active &= (header != 0) & (header != 0xffffffff)
+            hit = active & ((header & 0xffff) == id)
+            found[hit] = offset[hit]
+            active &= ~hit
+            offset = ((header >> 20) & 0xffc).astype(numpy.int32)
+            active &= (offset >= 0x100) & (offset + 4 <= self.lengths)
+        return found
+
+    def capability_offsets(self, id, extended=False):
+        "Offset of the first capability id in each row, -1 where there isn't one"
+        key = (id, extended)
+        ret = self.cap_offsets.get(key)
+        if ret is None:
+            if extended:
+                ret = self._walk_ext_caps(id)
+            else:
+                ret = self._walk_caps(id)
+            self.cap_offsets[key] = ret
+        return ret
+
+    def field(self, name):
+        "Masked array of the register or bit field name in every row"
+        try:
+            reg, location, id = field_locations()[name]
+        except KeyError:
+            raise RuntimeError("Unknown register %s" % (name))
+
+        if location == LOC_CAP:
+            base = self.capability_offsets(id)
+        elif location == LOC_EXT_CAP:
+            base = self.capability_offsets(id, extended=True)
+        else:
+            base = numpy.zeros(len(self.data), numpy.int32)
+        present = base >= 0
+        if location in (LOC_TYPE0, LOC_TYPE1):
+            header_type = self.field("common_header_type").filled(0xff) & 0xf
+            present &= header_type == location - LOC_TYPE0
+
+        offsets = base + reg.offset
+        present &= offsets + reg.length / 8 <= self.lengths
+        value = self.gather(offsets, reg.length)
+        if reg.bit_offset is not None:
+            value = (value >> reg.bit_offset) & ((1 << reg.bit_length) - 1)
+        return numpy.ma.masked_array(value, mask=~present)
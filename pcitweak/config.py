@@ -1,4 +1,4 @@
-import os
+import os, stat, struct, mmap, ctypes, threading
 from bitstring import BitString
 
 
@@ -6,88 +6,303 @@ from bitstring import BitString
 #### PCI Config Space Data Manipulation
 ####################################################################
 
-# When porting, this should be the only class in this file that needs work
+# When porting, the backends should be the only classes in this file that
+# need work.  A backend moves raw bytes in and out of one function's config
+# space and provides read(offset, nbytes), write(offset, data), size() and
+# close().
+
+class SysfsConfigBackend:
+    "The config file linux exposes for each device under /sys/devices"
+    def __init__(self, config_fn):
+        # Unbuffered, so a read only pulls the bytes asked for out of the
+        # device rather than a whole buffer's worth
+        self.config = open(config_fn, 'r+b', 0)
+
+    def read(self, offset, nbytes):
+        self.config.seek(offset)
+        return self.config.read(nbytes)
+
+    def write(self, offset, data):
+        self.config.seek(offset)
+        self.config.write(data)
+
+    def size(self):
+        return os.fstat(self.config.fileno()).st_size
+
+    def close(self):
+        self.config.close()
+
+class BufferConfigBackend:
+    """
+    Read only config space held in a buffer (a string, or an mmap shared by
+    many devices) starting at offset, see archive.py
+    """
+    def __init__(self, buf, offset=0, size=4096):
+        self.buf = buf
+        self.base = offset
+        self.length = size
+
+    def read(self, offset, nbytes):
+        # Like reading a file, stop at the end of this device's space
+        nbytes = max(0, min(nbytes, self.length - offset))
+        start = self.base + offset
+        return self.buf[start:start + nbytes]
+
+    def write(self, offset, data):
+        raise IOError("Config space buffer is read only")
+
+    def size(self):
+        return self.length
+
+    def close(self):
+        # The buffer belongs to whoever handed it over
+        pass
+
+# MMIO accesses are done as single loads and stores of these sizes
+mmio_types = {
+    1: (ctypes.c_uint8, struct.Struct("=B")),
+    2: (ctypes.c_uint16, struct.Struct("=H")),
+    4: (ctypes.c_uint32, struct.Struct("=I")),
+}
+
+def _buffer_address(buf):
+    "Address of the memory behind buf, works on read only mmaps too"
+    address = ctypes.c_void_p()
+    length = ctypes.c_ssize_t()
+    ctypes.pythonapi.PyObject_AsReadBuffer(ctypes.py_object(buf), ctypes.byref(address), ctypes.byref(length))
+    return address.value
+
+def _mmio_width(offset, end):
+    "Widest naturally aligned access at offset that stays below end"
+    for width in (4, 2):
+        if offset % width == 0 and offset + width <= end:
+            return width
+    return 1
+
+class MmapConfigBackend(BufferConfigBackend):
+    """
+    Config space mapped into memory, reads and writes are plain memory
+    accesses with no syscalls.  filename is either /dev/mem with offset
+    pointing at the function in an ECAM (MMCONFIG) window, see ecam_backend(),
+    or a config space image dumped to a file.
+
+    Device memory is accessed with naturally aligned 1, 2 and 4 byte loads
+    and stores, as config space over MMIO needs, images by copying slices.
+    size defaults to the rest of the file for an image, 4096 otherwise.
+    """
+    def __init__(self, filename, offset=0, size=None, writable=False):
+        self.writable = writable
+        # mmap wants a page aligned offset, map from the page start
+        aligned = offset - (offset % mmap.ALLOCATIONGRANULARITY)
+        if writable:
+            fd = os.open(filename, os.O_RDWR | os.O_SYNC)
+            prot = mmap.PROT_READ | mmap.PROT_WRITE
+        else:
+            fd = os.open(filename, os.O_RDONLY)
+            prot = mmap.PROT_READ
+        try:
+            st = os.fstat(fd)
+            self.mmio = not stat.S_ISREG(st.st_mode)
+            if size is None:
+                if self.mmio:
+                    size = 4096
+                else:
+                    size = max(0, min(st.st_size - offset, 4096))
+            self.mm = mmap.mmap(fd, offset - aligned + size, mmap.MAP_SHARED, prot, offset=aligned)
+        finally:
+            os.close(fd)
+        BufferConfigBackend.__init__(self, self.mm, offset - aligned, size)
+        self.address = None
+        if self.mmio:
+            self.address = _buffer_address(self.mm) + self.base
+
+    def read(self, offset, nbytes):
+        if not self.mmio:
+            return BufferConfigBackend.read(self, offset, nbytes)
+        end = offset + max(0, min(nbytes, self.length - offset))
+        ret = []
+        while offset < end:
+            width = _mmio_width(offset, end)
+            ctype, codec = mmio_types[width]
+            ret.append(codec.pack(ctype.from_address(self.address + offset).value))
+            offset += width
+        return "".join(ret)
+
+    def write(self, offset, data):
+        if not self.writable:
+            raise IOError("Config space mapping is read only")
+        if not self.mmio:
+            start = self.base + offset
+            self.mm[start:start + len(data)] = data
+            return
+        pos = 0
+        while pos < len(data):
+            width = _mmio_width(offset + pos, offset + len(data))
+            ctype, codec = mmio_types[width]
+            ctype.from_address(self.address + offset + pos).value = codec.unpack_from(data, pos)[0]
+            pos += width
+
+    def close(self):
+        self.address = None
+        self.mm.close()
+
+def mcfg_regions(mcfg_fn="/sys/firmware/acpi/tables/MCFG"):
+    """
+    ECAM windows from the ACPI MCFG table as (base address, segment,
+    start bus, end bus) tuples
+    """
+    f = open(mcfg_fn, 'rb')
+    try:
+        table = f.read()
+    finally:
+        f.close()
+    # 36 byte ACPI header and 8 reserved bytes, then 16 bytes per window
+    ret = []
+    for offset in range(44, len(table) - 15, 16):
+        ret.append(struct.unpack_from("<QHBB", table, offset))
+    return ret
+
+def ecam_backend(addr, regions=None, writable=False):
+    "MmapConfigBackend on /dev/mem for the function at addr"
+    if regions is None:
+        regions = mcfg_regions()
+    for base, segment, start_bus, end_bus in regions:
+        if segment == addr.domain and start_bus <= addr.bus <= end_bus:
+            # The window's base address is where bus 0 would be, even when
+            # it starts at a later bus
+            offset = (addr.bus << 20) | (addr.device << 15) | (addr.func << 12)
+            return MmapConfigBackend("/dev/mem", base + offset, 4096, writable)
+    raise RuntimeError("No ECAM window covers %s" % (str(addr)))
+
 class PCIConfigSpaceAccess:
-    def __init__(self, config_fn, device):
-        self.config = open(config_fn, 'r+')
+    def __init__(self, config_fn, device, snapshot=False, backend=None):
+        if backend is None:
+            backend = SysfsConfigBackend(config_fn)
+        self.backend = backend
         self.dev = device
-    
-    def __del__(self):
-        self.config.close()
+        # When snapshotting, the whole config space is held here and all
+        # reads are served from it until the next refresh()
+        self.snapshot = None
+        if snapshot:
+            self.refresh()
+
+    # No __del__, the access sits in a cycle with its device (dev._config
+    # -> PCIConfigSpace -> access -> dev) and python 2 can't collect cycles
+    # with finalizers.  Backends release what they hold when collected, call
+    # close() to do it sooner.
+    def close(self):
+        # __init__ may have failed before there was a backend
+        backend = getattr(self, "backend", None)
+        if backend is not None:
+            backend.close()
+
+    def size(self):
+        return self.backend.size()
+
+    def refresh(self):
+        """
+        Pull the whole config space (256 or 4096 bytes) in with a single read
+        and serve all further reads from that buffer
+        """
+        self.snapshot = self.backend.read(0, self.backend.size())
+
+    def read_block(self, offset, nbytes):
+        "Raw bytes, in one backend read unless they come from the snapshot"
+        if self.snapshot is not None:
+            return self.snapshot[offset:offset + nbytes]
+        return self.backend.read(offset, nbytes)
+
+    def _write_bytes(self, offset, data):
+        self.backend.write(offset, data)
+        if self.snapshot is not None:
+            # Read back what the hardware actually took (RO and RW1C bits
+            # won't match what was written) to keep the snapshot coherent
+            data = self.backend.read(offset, len(data))
+            self.snapshot = self.snapshot[:offset] + data + self.snapshot[offset + len(data):]
 
-    # XXX Hack, rewrite
-    def swap_le_be(self, bs):
-        ret = BitString(uintle=bs.uint, length=bs.length)
-        return ret
-        
     def read(self, offset, length, bit_offset=None, bit_length=None):
-        self.config.seek(offset)
-        data = self.config.read(length/8)
-        data = BitString(bytes=data, length=length)
-        data = self.swap_le_be(data)
-        #print "Read 0x%x at 0x%x" % (data.uint, offset)
-        
+        value = decode_reg(self.read_block(offset, length/8), 0, length)
         if bit_offset is None:
-            ret = data.uint
-        else:
-            #print data.bin
-            #print "Reading bit %d length %d" % (bit_offset, bit_length)
-            #for i in range(length):
-                #print "%d %d" % (i, data[i].uint)
-            #print "Using slice %d:%d" % ( length - (bit_offset + bit_length) , length - bit_offset )
-            #print data[ length - (bit_offset + bit_length) : length - bit_offset ].bin
-
-            # Bit slice addresses are reversed
-            ret = data[ length - (bit_offset + bit_length) : length - bit_offset ].uint
+            return value
+        return get_field(value, bit_offset, bit_length)
 
-        return ret
+    def read_device(self, offset, length):
+        """
+        Whole register straight from the device, even with a snapshot.  The
+        read half of a read-modify-write has to come from here, the snapshot
+        may be older than changes made through other handles.
+        """
+        return decode_reg(self.backend.read(offset, length/8), 0, length)
 
     def write(self, value, offset, length, bit_offset=None, bit_length=None):
         """
         If a whole register, writes value to the whole register
         If a bit field, reads the register and mods only the specified bit then writes that new value back
         """
-        if bit_offset is None:
-            data = BitString(uint=value, length=length)
-        else:
-            orig = self.read(offset, length)
-            #print "orig int 0x%x" % (orig)
-            orig = BitString(uint=orig, length=length)
-            #print "orig bs %s" % (orig.bin)
-            new = BitString(uint=value, length=bit_length)
-            #print "new bs %s going in at offset %d" % (new.bin, bit_offset)
-            # Slice addresses are in reverse order
-            orig.overwrite(new, length - (bit_offset + bit_length))
-            #orig.overwrite(new, bit_offset)
-            data = orig
-
-        #print "%s %s" % (data.hex, data.bin)
-        data = self.swap_le_be(data)
-        self.config.seek(offset)
-        self.config.write(data.bytes)
+        if bit_offset is not None:
+            value = set_field(self.read_device(offset, length), value, bit_offset, bit_length)
+        self._write_bytes(offset, encode_reg(value, length))
 
     def clear(self, offset, length, bit_offset=None, bit_length=None):
         """
         If a whole register, writes ones to the whole register
         If a bit field, writes a one to the specified bit with everything else being zero
         """
-        bs = BitString(length=length)
         if bit_offset is None:
-            bs = ~bs
+            value = (1 << length) - 1
         else:
-            # Slice addresses are backward, ex: msb is 0, lsb is 31 so bit_offset 32 is slice[0] (for 32 bit)
-            for i in range(length - (bit_offset + bit_length), length - bit_offset):
-                bs[i] = 1
+            value = field_mask(bit_offset, bit_length)
+        self.write(value, offset, length)
 
-        self.write(bs.uint, offset, length)
+####################################################################
+#### Register encode/decode
+####################################################################
+
+# Config space registers are little endian.  The naturally sized ones go
+# straight through struct, anything else (the 24 bit class code) falls back
+# to BitString.
+reg_codecs = {
+    8: struct.Struct("<B"),
+    16: struct.Struct("<H"),
+    32: struct.Struct("<I"),
+}
+
+def decode_reg(data, offset, length):
+    "Decode the length bit register at byte offset in data"
+    codec = reg_codecs.get(length)
+    if codec is not None:
+        return codec.unpack_from(data, offset)[0]
+    return BitString(bytes=data[offset:offset + length/8], length=length).uintle
+
+def encode_reg(value, length):
+    "Encode value as the raw bytes of a length bit register"
+    codec = reg_codecs.get(length)
+    if codec is not None:
+        return codec.pack(value)
+    return BitString(uintle=value, length=length).bytes
+
+def field_mask(bit_offset, bit_length):
+    return ((1 << bit_length) - 1) << bit_offset
+
+def get_field(value, bit_offset, bit_length):
+    return (value >> bit_offset) & ((1 << bit_length) - 1)
+
+def set_field(value, field, bit_offset, bit_length):
+    "Return value with the bit field replaced by field"
+    if field >> bit_length:
+        raise ValueError("Value 0x%x does not fit in a %d bit field" % (field, bit_length))
+    return (value & ~field_mask(bit_offset, bit_length)) | (field << bit_offset)
 
 
 ####################################################################
 #### Base Register Set
 ####################################################################
 class ConfigReg:
-    def __init__(self, name, length, base_offset, offset, bit_offset=None, bit_length=None):
-        self.base_offset = base_offset
+    """
+    Register descriptor, offset is relative to the base of whatever register
+    set it's part of so one descriptor serves every device
+    """
+    def __init__(self, name, length, offset, bit_offset=None, bit_length=None):
         self.name = name
         self.length = length
         self.offset = offset
@@ -97,42 +312,204 @@ class ConfigReg:
         else:
             self.bit_length = bit_length
 
-    def read(self, config):
-        offset = self.base_offset + self.offset
+    def read(self, config, base_offset=0):
+        offset = base_offset + self.offset
         return config.read(offset, self.length, self.bit_offset, self.bit_length)
 
-    def write(self, value, config):
-        offset = self.base_offset + self.offset
+    def write(self, value, config, base_offset=0):
+        offset = base_offset + self.offset
         config.write(value, offset, self.length, self.bit_offset, self.bit_length)
 
-    def clear(self, config):
+    def clear(self, config, base_offset=0):
+        offset = base_offset + self.offset
+        config.clear(offset, self.length, self.bit_offset, self.bit_length)
 
-        off = self.base_offset + self.offset
+    def enumerate(self, config, base_offset=0):
+        ret = "%s = 0x%x\n" % (self.name, self.read(config, base_offset))
+        return ret
 
-        data = BitString(length=self.length)
-        if self.bit_offset is None:
-            data = ~data
-        else:
-            for i in range(self.bit_offset, self.bit_offset+self.bit_length):
-                data[i] = 1
-        
-        #print data.bin
-        # file objects
-        config.seek(off)
-        config.write(data.bytes)
+class RegLayout:
+    """
+    Compiled table of register descriptors, shared by every register set with
+    the same shape.  A layout is made of one or more parts (the header, each
+    capability...), register offsets are relative to their part and the
+    register set using the layout holds the base offset of each part.
+    """
+    def __init__(self, name, nparts=1):
+        self.name = name
+        self.nparts = nparts
+        # Kept in definition order
+        self.regs = []
+        self.parts = []
+        # name -> (ConfigReg, part)
+        self.regs_byname = {}
+        self.compiled = False
+        # other layout -> this layout extended with it
+        self.merged = {}
 
-    def enumerate(self, config):
-        ret = "%s = 0x%x\n" % (self.name, self.read(config))
+    def add(self, reg, part=0):
+        if self.compiled:
+            raise RuntimeError("Register layout %s is compiled, can't add %s" % (self.name, reg.name))
+        # Check for collisions
+        if reg.name in self.regs_byname:
+            raise RuntimeError("Register %s already exsits in set %s" % (reg.name, self.name))
+        self.regs.append(reg)
+        self.parts.append(part)
+        self.regs_byname[reg.name] = (reg, part)
+
+    def merge(self, other):
+        "Return this layout followed by other, each combination is only built once"
+        ret = self.merged.get(other)
+        if ret is not None:
+            return ret
+        layout_lock.acquire()
+        try:
+            return self._merge(other)
+        finally:
+            layout_lock.release()
+
+    def _merge(self, other):
+        # Another thread may have built it while this one waited
+        ret = self.merged.get(other)
+        if ret is not None:
+            return ret
+
+        for reg in other.regs:
+            if reg.name in self.regs_byname:
+                raise RuntimeError("Error extending Reg Set '%s' with '%s', conflict on reg '%s'" % (self.name, other.name, reg.name))
+
+        ret = RegLayout(self.name, self.nparts + other.nparts)
+        ret.regs = self.regs + other.regs
+        ret.parts = self.parts + [self.nparts + part for part in other.parts]
+        ret.regs_byname = self.regs_byname.copy()
+        for reg, part in other.regs_byname.itervalues():
+            ret.regs_byname[reg.name] = (reg, self.nparts + part)
+        ret.compiled = True
+        self.merged[other] = ret
         return ret
 
+# (register set class, name) -> RegLayout
+reg_layouts = {}
+
+# Held while adding to reg_layouts, reg_offset_indexes or a layout's merged
+# cache, threaded discovery builds register sets from several threads.
+# Lookups go without it, a layout is only published once it's complete.
+layout_lock = threading.RLock()
+
+def part_ends(bases):
+    """
+    Where each part placed at bases stops: the next part's base, or the end
+    of the first 256 bytes or of the extended space it's in
+    """
+    starts = sorted(set(bases))
+    ret = []
+    for base in bases:
+        if base < 0x100:
+            end = 0x100
+        else:
+            end = 0x1000
+        for start in starts:
+            if base < start < end:
+                end = start
+                break
+        ret.append(end)
+    return ret
+
+class RegOffsetIndex:
+    """
+    Reverse index of a layout placed at a set of bases, from absolute byte
+    offset (and bit range) to the registers covering it.  Registers are at
+    most 4 bytes so each byte keeps the list of spans touching it.
+    """
+    def __init__(self, layout, bases):
+        # byte -> [(first bit, end bit, definition order, reg, absolute
+        # offset)], bits are absolute, offset * 8 + bit
+        self.bytes = {}
+        ends = part_ends(bases)
+        for order, (reg, part) in enumerate(zip(layout.regs, layout.parts)):
+            offset = bases[part] + reg.offset
+            if offset + reg.length / 8 > ends[part]:
+                # Runs into the next capability, those bytes aren't this
+                # register's
+                continue
+            start = offset * 8
+            end = start + reg.length
+            if reg.bit_offset is not None:
+                start += reg.bit_offset
+                end = start + reg.bit_length
+            for byte in range(start / 8, (end + 7) / 8):
+                self.bytes.setdefault(byte, []).append((start, end, order, reg, offset))
+
+    def lookup(self, offset, nbytes=1, bit_offset=None, bit_length=None):
+        """
+        (reg, absolute offset) for each register overlapping nbytes at offset,
+        or only the bits bit_offset to bit_offset + bit_length of them, in
+        offset then definition order
+        """
+        start = offset * 8
+        end = start + nbytes * 8
+        if bit_offset is not None:
+            start += bit_offset
+            if bit_length is None:
+                bit_length = 1
+            end = start + bit_length
+
+        ret = []
+        seen = set()
+        for byte in range(start / 8, (end + 7) / 8):
+            for reg_start, reg_end, order, reg, reg_offset in self.bytes.get(byte, []):
+                if reg_start < end and start < reg_end and order not in seen:
+                    seen.add(order)
+                    ret.append((reg_offset, order, reg))
+        ret.sort()
+        return [(reg, reg_offset) for reg_offset, order, reg in ret]
+
+# (layout, bases) -> RegOffsetIndex
+reg_offset_indexes = {}
+
 class ConfigRegSet:
+    # Attributes copied onto the set this one extends
+    extend_attrs = []
+
     def __init__(self, name, base_offset, config):
         self.name = name
-        self.regs = []
-        self.regs_byname = {}
         self.base_offset = base_offset
         self.config = config
-        self.extend_attrs = []
+        # Base offset of each part of the layout
+        self.bases = (base_offset,)
+
+        key = self.layout_key()
+        layout = reg_layouts.get(key)
+        if layout is None:
+            layout_lock.acquire()
+            try:
+                layout = reg_layouts.get(key)
+                if layout is None:
+                    # First one of these, build the layout everyone else
+                    # will share
+                    self._set_layout(RegLayout(name))
+                    self.define()
+                    self.layout.compiled = True
+                    reg_layouts[key] = layout = self.layout
+            finally:
+                layout_lock.release()
+        self._set_layout(layout)
+
+    def layout_key(self):
+        """
+        Register sets with the same key share a layout, override when the
+        registers defined depend on the device
+        """
+        return (self.__class__, self.name)
+
+    def _set_layout(self, layout):
+        self.layout = layout
+        self.regs = layout.regs
+        self.regs_byname = layout.regs_byname
+
+    def define(self):
+        "Override to add() the set's registers, only run once per layout"
+        pass
 
     def __contains__(self, name):
         if name in self.regs_byname:
@@ -144,25 +521,12 @@ class ConfigRegSet:
         for reg in self.regs:
             yield reg.name
         
-    def add(self, name, length, offset, base_offset=None, bit_offset=None, bit_length=None):
-        if base_offset is None:
-            base_offset = self.base_offset
-        # Check for collisions
-        if name in self.regs_byname:
-            raise RuntimeError("Register %s already exsits in set %s" % (self.name, name))
-        
-        reg = ConfigReg(name, length, base_offset, offset, bit_offset, bit_length)
-        self.regs.append(reg)
-        self.regs_byname[name] = reg
+    def add(self, name, length, offset, bit_offset=None, bit_length=None):
+        self.layout.add(ConfigReg(name, length, offset, bit_offset, bit_length))
 
     def extend(self, other):
-        for rself in self.regs:
-            if rself.name in other.regs_byname:
-                raise RuntimeError("Error extending Reg Set '%s' with '%s', conflict on reg '%s'" % (self.name, other.name, rself.name))
-                
-        self.regs.extend(other.regs)
-        for reg in self.regs:
-            self.regs_byname[reg.name] = reg
+        self._set_layout(self.layout.merge(other.layout))
+        self.bases = self.bases + other.bases
 
         for attr in other.extend_attrs:
             if attr in self:
@@ -170,13 +534,41 @@ class ConfigRegSet:
             setattr(self, attr, getattr(other, attr))
 
     def read(self, reg_name):
-        return self.regs_byname[reg_name].read(self.config)
+        reg, part = self.regs_byname[reg_name]
+        return reg.read(self.config, self.bases[part])
         
     def write(self, reg_name, value):
-        return self.regs_byname[reg_name].write(value, self.config)
+        reg, part = self.regs_byname[reg_name]
+        return reg.write(value, self.config, self.bases[part])
 
     def clear(self, reg_name):
-        return self.regs_byname[reg_name].clear(self.config)
+        reg, part = self.regs_byname[reg_name]
+        return reg.clear(self.config, self.bases[part])
+
+    def batch(self):
+        "Start a ConfigWriteBatch against this set's registers"
+        return ConfigWriteBatch(self)
+
+    def offset_index(self):
+        "RegOffsetIndex for this set, built once per layout and bases"
+        key = (self.layout, self.bases)
+        index = reg_offset_indexes.get(key)
+        if index is None:
+            layout_lock.acquire()
+            try:
+                index = reg_offset_indexes.get(key)
+                if index is None:
+                    index = reg_offset_indexes[key] = RegOffsetIndex(self.layout, self.bases)
+            finally:
+                layout_lock.release()
+        return index
+
+    def regs_at(self, offset, nbytes=1, bit_offset=None, bit_length=None):
+        """
+        The ConfigRegs covering nbytes at absolute offset, ex: regs_at(0x4a)
+        for every field touching byte 0x4a, see RegOffsetIndex.lookup()
+        """
+        return [reg for reg, reg_offset in self.offset_index().lookup(offset, nbytes, bit_offset, bit_length)]
 
     def avaliable(self):
         # pull from list to keep in order
@@ -185,18 +577,145 @@ class ConfigRegSet:
     def enumerate(self):
         ret = "\n"
         ret += "Register Set %s\n" % (self.name)
-        for reg in self.regs:
-            ret += reg.enumerate(self.config)
+        for reg, part in zip(self.regs, self.layout.parts):
+            ret += reg.enumerate(self.config, self.bases[part])
         return ret
 
+class ConfigWriteBatch:
+    """
+    Collects register writes and applies them with one read-modify-write per
+    touched register, in offset order, at commit():
+
+        batch = dev.config.batch()
+        batch.write("pcie_device_control_max_payload_size", 1)
+        batch.write("pcie_device_control_max_read_request_size", 5)
+        batch.commit()
+
+    Can also be used as a with block, which commits unless the block raises.
+    """
+    def __init__(self, regset):
+        self.regset = regset
+        # (absolute offset, length) -> [value, write mask, clear mask]
+        self.words = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        return False
+
+    def _word(self, reg_name):
+        reg, part = self.regset.regs_byname[reg_name]
+        key = (self.regset.bases[part] + reg.offset, reg.length)
+        word = self.words.get(key)
+        if word is None:
+            word = self.words[key] = [0, 0, 0]
+        if reg.bit_offset is None:
+            mask = (1 << reg.length) - 1
+        else:
+            mask = field_mask(reg.bit_offset, reg.bit_length)
+        return reg, word, mask
+
+    def write(self, reg_name, value):
+        # Refused here rather than at commit, when other registers may
+        # already have been written
+        reg, part = self.regset.regs_byname[reg_name]
+        if reg.bit_offset is not None:
+            value = set_field(0, value, reg.bit_offset, reg.bit_length)
+        elif value < 0 or value >> reg.length:
+            raise ValueError("Value 0x%x does not fit in a %d bit register" % (value, reg.length))
+        reg, word, mask = self._word(reg_name)
+        word[0] = (word[0] & ~mask) | value
+        word[1] |= mask
+
+    def clear(self, reg_name):
+        "Same as ConfigRegSet.clear(), ones to the field and zeros everywhere else"
+        reg, word, mask = self._word(reg_name)
+        word[2] |= mask
+
+    def commit(self):
+        """
+        Write every register touched, in offset order.  The whole batch is
+        checked before the first write, if it's refused nothing is written
+        and the batch is left as it was.
+        """
+        config = self.regset.config
+        for offset, length in self.words:
+            value, mask, clear = self.words[(offset, length)]
+            # Writing back the rest of the register would clear any other
+            # RW1C bits that happen to be set
+            if clear and mask:
+                raise RuntimeError("Can't both write and clear the register at 0x%x in one batch" % (offset))
+        for offset, length in sorted(self.words):
+            value, mask, clear = self.words[(offset, length)]
+            if clear:
+                config.write(clear, offset, length)
+                continue
+            if mask != (1 << length) - 1:
+                value = (config.read_device(offset, length) & ~mask) | value
+            config.write(value, offset, length)
+        self.words = {}
+
+####################################################################
+#### Capability Lists
+####################################################################
+
+def scan_capabilities(data):
+    """
+    Walk the capability list and the PCIe extended capability list of a raw
+    config space image.  Returns two lists of (capability id, base offset) in
+    chain order, legacy then extended.  Stops early on loops, bad pointers or
+    if data is short (the extended space is only readable by root).
+    """
+    caps = []
+    visited = set()
+    if len(data) > 0x34:
+        offset = ord(data[0x34]) & 0xfc
+        # Capabilities live after the 64 byte header in the first 256 bytes
+        while 0x40 <= offset < 0x100 and offset + 2 <= len(data) and offset not in visited:
+            visited.add(offset)
+            caps.append((ord(data[offset]), offset))
+            offset = ord(data[offset + 1]) & 0xfc
+
+    ext_caps = []
+    offset = 0x100
+    while offset >= 0x100 and offset + 4 <= len(data) and offset not in visited:
+        visited.add(offset)
+        header = decode_reg(data, offset, 32)
+        if header == 0x0 or header == 0xffffffff:
+            break
+        ext_caps.append((get_field(header, 0, 16), offset))
+        offset = get_field(header, 20, 12) & 0xffc
+
+    return caps, ext_caps
+
+def first_offsets(caps):
+    "capability id -> offset of the first one with that id"
+    ret = {}
+    for id, offset in caps:
+        ret.setdefault(id, offset)
+    return ret
+
 ####################################################################
 #### Main class for external consumption
 ####################################################################
 
 class PCIConfigSpace(ConfigRegSet):
-    def __init__(self, config): 
+    def __init__(self, config, caps=None): 
+        """
+        caps: (caps, ext_caps) as found by an earlier scan_capabilities() of
+              this device, saves reading the whole space to find them again
+        """
 
         ConfigRegSet.__init__(self, "Config space master", 0x0, config)
+        # (capability id, offset) in chain order, filled in once the header
+        # type is known
+        self.caps = []
+        self.ext_caps = []
+        self.cap_offsets = {}
+        self.ext_cap_offsets = {}
 
         cs = ConfigPCICommon(self.config)
         self.extend(cs)
@@ -215,10 +734,47 @@ class PCIConfigSpace(ConfigRegSet):
 
         self.extend(cs)
 
-        cap = self._get_first_cap()
-        while cap is not None:
-            self.extend(cap)
-            cap = cap.get_next_cap()
+        # Index both capability lists from one read of the whole space, then
+        # build the register sets straight from the index rather than hopping
+        # down the chain a register read at a time
+        if caps is None:
+            data = self.config.read_block(0, self.config.size())
+            caps = scan_capabilities(data)
+        self.caps, self.ext_caps = caps
+        self.cap_offsets = first_offsets(self.caps)
+        self.ext_cap_offsets = first_offsets(self.ext_caps)
+
+        # Some capabilities (vendor specific ones) can show up more than once,
+        # their register names would clash so only the first gets merged
+        for id, offset in self.caps:
+            if self.cap_offsets[id] == offset:
+                self.extend(get_cap_type(id, offset, self.config))
+
+        for id, offset in self.ext_caps:
+            if self.ext_cap_offsets[id] == offset:
+                self.extend(get_ext_cap_type(id, offset, self.config))
+
+    def find_capability(self, id, extended=False):
+        "Base offset of the (first) capability with this ID, None if there isn't one"
+        if extended:
+            return self.ext_cap_offsets.get(id)
+        return self.cap_offsets.get(id)
+
+    def has_capability(self, id, extended=False):
+        return self.find_capability(id, extended) is not None
+
+    def capability(self, id, extended=False):
+        "Register set for just this capability, None if the device doesn't have it"
+        offset = self.find_capability(id, extended)
+        if offset is None:
+            return None
+        if extended:
+            return get_ext_cap_type(id, offset, self.config)
+        return get_cap_type(id, offset, self.config)
+
+    def refresh(self):
+        "Re-read the whole config space, further reads are served from the snapshot"
+        self.config.refresh()
 
     def _get_first_cap(self):
         offset = self.read("common_capabilities_pointer")
@@ -227,7 +783,7 @@ class PCIConfigSpace(ConfigRegSet):
         cap = CapabilityRegSet("Base CapabilityRegSet", offset, 0x0, self.config, "none")
         cap = cap.get_cap_type()
         return cap
-       
+
     def enumerate_all(self):
         print self.enumerate()
         if self.read("common_header_type") == 0:
@@ -236,10 +792,11 @@ class PCIConfigSpace(ConfigRegSet):
             cs_type = ConfigPCIType1(self.config)
         print cs_type.enumerate()
 
-        cap = self._get_first_cap()
-        while cap is not None:
-            print cap.enumerate()
-            cap = cap.get_next_cap()
+        for id, offset in self.caps:
+            print get_cap_type(id, offset, self.config).enumerate()
+
+        for id, offset in self.ext_caps:
+            print get_ext_cap_type(id, offset, self.config).enumerate()
    
 ####################################################################
 #### Common Register Set Definitions
@@ -248,6 +805,8 @@ class PCIConfigSpace(ConfigRegSet):
 class ConfigPCICommon(ConfigRegSet):
     def __init__(self, config):
         ConfigRegSet.__init__(self, "Common Configuration Space", 0x0, config)
+
+    def define(self):
         self.add("common_vendor_id", 16, 0x00)
         self.add("common_device_id", 16, 0x02)
         self.add("common_command", 16, 0x04)
@@ -291,6 +850,8 @@ class ConfigPCICommon(ConfigRegSet):
 class ConfigPCIType0(ConfigRegSet):
     def __init__(self, config):
         ConfigRegSet.__init__(self, "Type 0 Configuration Space", 0x0, config)
+
+    def define(self):
         # XXX BARs at addresses starting at 0x10 and ending at 0x27
         self.add("type0_cardbus_cis_pointer", 32, 0x28)
         self.add("type0_subsystem_vendor_id", 16, 0x2c)
@@ -302,6 +863,8 @@ class ConfigPCIType0(ConfigRegSet):
 class ConfigPCIType1(ConfigRegSet):
     def __init__(self, config):
         ConfigRegSet.__init__(self, "Type 1 Configuration Space", 0x0, config)
+
+    def define(self):
         # XXX BARs at addresses starting at 0x10 and ending at 0x17
         self.add("type1_primary_bus_number", 8, 0x18)
         self.add("type1_secondary_bus_number", 8, 0x19)
@@ -348,21 +911,18 @@ class ConfigPCIType1(ConfigRegSet):
 cap_types = {}
 class CapabilityRegSet(ConfigRegSet):
     def __init__(self, name, base_offset, capability_id, config, prefix):
-        ConfigRegSet.__init__(self, name, base_offset, config)
         self.capability_id = capability_id
         self.prefix = prefix
-        self.add("%s_capability_id" % (prefix), 8, 0x0)
-        self.add("%s_capability_next" % (prefix), 8, 0x1)
+        ConfigRegSet.__init__(self, name, base_offset, config)
+
+    def define(self):
+        self.add("%s_capability_id" % (self.prefix), 8, 0x0)
+        self.add("%s_capability_next" % (self.prefix), 8, 0x1)
 
     def get_cap_type(self):
         "Convert a generic capability structure to a specific one for that cap type"
         id = self.read("%s_capability_id" % (self.prefix))
-        try:
-            cap = cap_types[id](self.base_offset, self.config)
-        except KeyError:
-            #print "WARNING: unknown capability at 0x%x of type 0x%x" % (self.base_offset, id)
-            cap = CapabilityRegSet("Unknown Capability ID 0x%x" % (id), self.base_offset, id, self.config, "cap_%02x" % (id))
-        return cap
+        return get_cap_type(id, self.base_offset, self.config)
        
     def get_next_cap(self):
         "Get the next capability in the tree, return None of at end"
@@ -381,6 +941,15 @@ class CapabilityRegSet(ConfigRegSet):
         """
         pass
 
+def get_cap_type(id, base_offset, config):
+    "Register set for the capability id found at base_offset"
+    try:
+        cap = cap_types[id](base_offset, config)
+    except KeyError:
+        #print "WARNING: unknown capability at 0x%x of type 0x%x" % (base_offset, id)
+        cap = CapabilityRegSet("Unknown Capability ID 0x%x" % (id), base_offset, id, config, "cap_%02x" % (id))
+    return cap
+
 ####################################################################
 #### Capability Register Set Definitions
 ####################################################################
@@ -409,8 +978,43 @@ class CapabilityMSIX(CapabilityRegSet):
 
 cap_types[0x10] = lambda base_offset, config: CapabilityPCIExpress(base_offset, config)
 class CapabilityPCIExpress(CapabilityRegSet):
+    devports = {
+        0x0: "PCI Express Endpoint Device",
+        0x1: "Legacy PCI Express Endpoint device",
+        0x2: "Undefined",
+        0x3: "Undefined",
+        0x4: "Root Port of PCI Express Root Complex",
+        0x5: "Upstream Port of PCI Express Switch",
+        0x6: "Downstream Port of PCI Express Switch",
+        0x7: "PCI Expressto-PCI/PCI-X Bridge",
+        0x8: "PCI/PCI-X to PCI Express Bridge",
+        0x9: "Root Complex Integrated Endpoint Device",
+        0xa: "Root Complex Event Collector",
+    }
+
+    maxsize = {
+        0: "128 bytes",
+        1: "256 bytes",
+        2: "512 bytes",
+        3: "1024 bytes",
+        4: "2048 bytes",
+        5: "4096 bytes",
+    }
+
+    slot_power_scale = {
+            0b00: 1,
+            0b01: 0.1,
+            0b10: 0.01,
+            0b11: 0.001
+    }
+
+    extend_attrs = ['slot_power_scale', 'get_pcie_slot_cap_watts', 'set_pcie_slot_cap_watts']
+
     def __init__(self, base_offset, config):
         CapabilityRegSet.__init__(self, "PCI Express Capability Structure", base_offset, 0x10, config, "pcie")
+
+    def define(self):
+        CapabilityRegSet.define(self)
         self.add_pcie_cap()
         self.add_pcie_device()
         self.add_pcie_link()
@@ -427,19 +1031,6 @@ class CapabilityPCIExpress(CapabilityRegSet):
         self.add("pcie_cap_register_slot_implemented", 16, 0x02, bit_offset=8, bit_length=1)
         self.add("pcie_cap_register_interrupt_message_number", 16, 0x02, bit_offset=9, bit_length=5)
 
-        self.devports = {}
-        self.devports[0x0] = "PCI Express Endpoint Device"
-        self.devports[0x1] = "Legacy PCI Express Endpoint device"
-        self.devports[0x2] = "Undefined"
-        self.devports[0x3] = "Undefined"
-        self.devports[0x4] = "Root Port of PCI Express Root Complex"
-        self.devports[0x5] = "Upstream Port of PCI Express Switch"
-        self.devports[0x6] = "Downstream Port of PCI Express Switch"
-        self.devports[0x7] = "PCI Expressto-PCI/PCI-X Bridge"
-        self.devports[0x8] = "PCI/PCI-X to PCI Express Bridge"
-        self.devports[0x9] = "Root Complex Integrated Endpoint Device"
-        self.devports[0xa] = "Root Complex Event Collector"
-
     def add_pcie_device(self):
         ## All Devices
         self.add("pcie_device_capabilities", 32, 0x04)
@@ -474,14 +1065,6 @@ class CapabilityPCIExpress(CapabilityRegSet):
         self.add("pcie_device_status_aux_power_detected", 16, 0x0a, bit_offset=4)
         self.add("pcie_device_status_transactions_pending", 16, 0x0a, bit_offset=5)
 
-        self.maxsize = {}
-        self.maxsize[0] = "128 bytes"
-        self.maxsize[1] = "256 bytes"
-        self.maxsize[2] = "512 bytes"
-        self.maxsize[3] = "1024 bytes"
-        self.maxsize[4] = "2048 bytes"
-        self.maxsize[5] = "4096 bytes"
-
     def add_pcie_link(self):
         ## Devices with Links, Ports with Slots, Root Ports
         self.add("pcie_link_capabilities", 32, 0x0c)
@@ -528,14 +1111,6 @@ class CapabilityPCIExpress(CapabilityRegSet):
         self.add("pcie_slot_capabilities_slot_no_command_completed_support",        32, 0x14, bit_offset=18, bit_length=1)
         self.add("pcie_slot_capabilities_physical_slot_number",                     32, 0x14, bit_offset=19, bit_length=13)
 
-        self.slot_power_scale = {
-                0b00: 1,
-                0b01: 0.1,
-                0b10: 0.01,
-                0b11: 0.001
-        }
-        self.extend_attrs.append('slot_power_scale')
-
         self.add("pcie_slot_control", 16, 0x18)
         self.add("pcie_slot_control_attention_button_press_enable",         16, 0x18, bit_offset=0, bit_length=1)
         self.add("pcie_slot_control_power_fault_detection_enable",          16, 0x18, bit_offset=1, bit_length=1)
@@ -562,9 +1137,6 @@ class CapabilityPCIExpress(CapabilityRegSet):
         self.add("pcie_slot_status_data_link_layer_state_changed",          16, 0x1a, bit_offset=8, bit_length=1)
         self.add("pcie_slot_status_reserved",                               16, 0x1a, bit_offset=9, bit_length=7)
 
-        self.extend_attrs.append('get_pcie_slot_cap_watts')
-        self.extend_attrs.append('set_pcie_slot_cap_watts')
-
     def get_pcie_slot_cap_watts(self):
         pwr_value = self.read("pcie_slot_capabilities_slot_power_limit_value")
         pwr_scale = self.read("pcie_slot_capabilities_slot_power_limit_scale")
@@ -617,7 +1189,32 @@ class CapabilityPCIExpress(CapabilityRegSet):
     def add_pcie_device2(self):
         ## Device2 Registers
         self.add("pcie_device2_capabilities", 32, 0x24)
+        self.add("pcie_device2_capabilities_completion_timeout_ranges_supported", 32, 0x24, bit_offset=0, bit_length=4)
+        self.add("pcie_device2_capabilities_completion_timeout_disable_supported", 32, 0x24, bit_offset=4)
+        self.add("pcie_device2_capabilities_ari_forwarding_supported", 32, 0x24, bit_offset=5)
+        self.add("pcie_device2_capabilities_atomicop_routing_supported", 32, 0x24, bit_offset=6)
+        self.add("pcie_device2_capabilities_32bit_atomicop_completer_supported", 32, 0x24, bit_offset=7)
+        self.add("pcie_device2_capabilities_64bit_atomicop_completer_supported", 32, 0x24, bit_offset=8)
+        self.add("pcie_device2_capabilities_128bit_cas_completer_supported", 32, 0x24, bit_offset=9)
+        self.add("pcie_device2_capabilities_no_ro_enabled_pr_pr_passing", 32, 0x24, bit_offset=10)
+        self.add("pcie_device2_capabilities_ltr_mechanism_supported", 32, 0x24, bit_offset=11)
+        self.add("pcie_device2_capabilities_tph_completer_supported", 32, 0x24, bit_offset=12, bit_length=2)
+        self.add("pcie_device2_capabilities_10bit_tag_completer_supported", 32, 0x24, bit_offset=16)
+        self.add("pcie_device2_capabilities_10bit_tag_requester_supported", 32, 0x24, bit_offset=17)
+        self.add("pcie_device2_capabilities_obff_supported", 32, 0x24, bit_offset=18, bit_length=2)
+
         self.add("pcie_device2_control", 16, 0x28)
+        self.add("pcie_device2_control_completion_timeout_value", 16, 0x28, bit_offset=0, bit_length=4)
+        self.add("pcie_device2_control_completion_timeout_disable", 16, 0x28, bit_offset=4)
+        self.add("pcie_device2_control_ari_forwarding_enable", 16, 0x28, bit_offset=5)
+        self.add("pcie_device2_control_atomicop_requester_enable", 16, 0x28, bit_offset=6)
+        self.add("pcie_device2_control_atomicop_egress_blocking", 16, 0x28, bit_offset=7)
+        self.add("pcie_device2_control_ido_request_enable", 16, 0x28, bit_offset=8)
+        self.add("pcie_device2_control_ido_completion_enable", 16, 0x28, bit_offset=9)
+        self.add("pcie_device2_control_ltr_mechanism_enable", 16, 0x28, bit_offset=10)
+        self.add("pcie_device2_control_10bit_tag_requester_enable", 16, 0x28, bit_offset=12)
+        self.add("pcie_device2_control_obff_enable", 16, 0x28, bit_offset=13, bit_length=2)
+
         self.add("pcie_device2_status", 16, 0x2a)
 
     def add_pcie_link2(self):
@@ -630,3 +1227,285 @@ class CapabilityPCIExpress(CapabilityRegSet):
         self.add("pcie_slot2_control", 16, 0x38)
         self.add("pcie_slot2_status", 16, 0x3a)
 
+####################################################################
+#### Base Extended Capability Register Set
+####################################################################
+ext_cap_types = {}
+class ExtCapabilityRegSet(ConfigRegSet):
+    "PCIe extended capability, these live in the extended space from 0x100 up"
+    def __init__(self, name, base_offset, capability_id, config, prefix):
+        self.capability_id = capability_id
+        self.prefix = prefix
+        ConfigRegSet.__init__(self, name, base_offset, config)
+
+    def define(self):
+        self.add("%s_capability_header" % (self.prefix), 32, 0x0)
+        self.add("%s_capability_id" % (self.prefix), 32, 0x0, bit_offset=0, bit_length=16)
+        self.add("%s_capability_version" % (self.prefix), 32, 0x0, bit_offset=16, bit_length=4)
+        self.add("%s_capability_next" % (self.prefix), 32, 0x0, bit_offset=20, bit_length=12)
+
+def get_ext_cap_type(id, base_offset, config):
+    "Register set for the extended capability id found at base_offset"
+    try:
+        cap = ext_cap_types[id](base_offset, config)
+    except KeyError:
+        cap = ExtCapabilityRegSet("Unknown Extended Capability ID 0x%x" % (id), base_offset, id, config, "ext_cap_%04x" % (id))
+    return cap
+
+####################################################################
+#### Extended Capability Register Set Definitions
+####################################################################
+
+ext_cap_types[0x0001] = lambda base_offset, config: ExtCapabilityAER(base_offset, config)
+class ExtCapabilityAER(ExtCapabilityRegSet):
+    def __init__(self, base_offset, config):
+        ExtCapabilityRegSet.__init__(self, "Advanced Error Reporting Extended Capability", base_offset, 0x0001, config, "aer")
+
+    def define(self):
+        ExtCapabilityRegSet.define(self)
+        self.add("aer_uncorrectable_error_status", 32, 0x04)
+        self.add("aer_uncorrectable_error_status_data_link_protocol_error", 32, 0x04, bit_offset=4)
+        self.add("aer_uncorrectable_error_status_surprise_down_error", 32, 0x04, bit_offset=5)
+        self.add("aer_uncorrectable_error_status_poisoned_tlp", 32, 0x04, bit_offset=12)
+        self.add("aer_uncorrectable_error_status_flow_control_protocol_error", 32, 0x04, bit_offset=13)
+        self.add("aer_uncorrectable_error_status_completion_timeout", 32, 0x04, bit_offset=14)
+        self.add("aer_uncorrectable_error_status_completer_abort", 32, 0x04, bit_offset=15)
+        self.add("aer_uncorrectable_error_status_unexpected_completion", 32, 0x04, bit_offset=16)
+        self.add("aer_uncorrectable_error_status_receiver_overflow", 32, 0x04, bit_offset=17)
+        self.add("aer_uncorrectable_error_status_malformed_tlp", 32, 0x04, bit_offset=18)
+        self.add("aer_uncorrectable_error_status_ecrc_error", 32, 0x04, bit_offset=19)
+        self.add("aer_uncorrectable_error_status_unsupported_request_error", 32, 0x04, bit_offset=20)
+        self.add("aer_uncorrectable_error_status_acs_violation", 32, 0x04, bit_offset=21)
+        self.add("aer_uncorrectable_error_mask", 32, 0x08)
+        self.add("aer_uncorrectable_error_severity", 32, 0x0c)
+
+        self.add("aer_correctable_error_status", 32, 0x10)
+        self.add("aer_correctable_error_status_receiver_error", 32, 0x10, bit_offset=0)
+        self.add("aer_correctable_error_status_bad_tlp", 32, 0x10, bit_offset=6)
+        self.add("aer_correctable_error_status_bad_dllp", 32, 0x10, bit_offset=7)
+        self.add("aer_correctable_error_status_replay_num_rollover", 32, 0x10, bit_offset=8)
+        self.add("aer_correctable_error_status_replay_timer_timeout", 32, 0x10, bit_offset=12)
+        self.add("aer_correctable_error_status_advisory_non-fatal_error", 32, 0x10, bit_offset=13)
+        self.add("aer_correctable_error_status_corrected_internal_error", 32, 0x10, bit_offset=14)
+        self.add("aer_correctable_error_status_header_log_overflow", 32, 0x10, bit_offset=15)
+        self.add("aer_correctable_error_mask", 32, 0x14)
+
+        self.add("aer_capabilities_and_control", 32, 0x18)
+        self.add("aer_capabilities_and_control_first_error_pointer", 32, 0x18, bit_offset=0, bit_length=5)
+        self.add("aer_capabilities_and_control_ecrc_generation_capable", 32, 0x18, bit_offset=5)
+        self.add("aer_capabilities_and_control_ecrc_generation_enable", 32, 0x18, bit_offset=6)
+        self.add("aer_capabilities_and_control_ecrc_check_capable", 32, 0x18, bit_offset=7)
+        self.add("aer_capabilities_and_control_ecrc_check_enable", 32, 0x18, bit_offset=8)
+
+        for i in range(4):
+            self.add("aer_header_log_%d" % (i), 32, 0x1c + i * 4)
+
+        ## Root Ports, Root Complex Event Collector
+        self.add("aer_root_error_command", 32, 0x2c)
+        self.add("aer_root_error_command_correctable_error_reporting_enable", 32, 0x2c, bit_offset=0)
+        self.add("aer_root_error_command_non-fatal_error_reporting_enable", 32, 0x2c, bit_offset=1)
+        self.add("aer_root_error_command_fatal_error_reporting_enable", 32, 0x2c, bit_offset=2)
+
+        self.add("aer_root_error_status", 32, 0x30)
+        self.add("aer_root_error_status_err_cor_received", 32, 0x30, bit_offset=0)
+        self.add("aer_root_error_status_multiple_err_cor_received", 32, 0x30, bit_offset=1)
+        self.add("aer_root_error_status_err_fatal_non-fatal_received", 32, 0x30, bit_offset=2)
+        self.add("aer_root_error_status_multiple_err_fatal_non-fatal_received", 32, 0x30, bit_offset=3)
+        self.add("aer_root_error_status_first_uncorrectable_fatal", 32, 0x30, bit_offset=4)
+        self.add("aer_root_error_status_non-fatal_error_messages_received", 32, 0x30, bit_offset=5)
+        self.add("aer_root_error_status_fatal_error_messages_received", 32, 0x30, bit_offset=6)
+        self.add("aer_root_error_status_advanced_error_interrupt_message_number", 32, 0x30, bit_offset=27, bit_length=5)
+
+        self.add("aer_error_source_err_cor_id", 16, 0x34)
+        self.add("aer_error_source_err_fatal_non-fatal_id", 16, 0x36)
+
+
+ext_cap_types[0x0003] = lambda base_offset, config: ExtCapabilityDSN(base_offset, config)
+class ExtCapabilityDSN(ExtCapabilityRegSet):
+    extend_attrs = ['get_device_serial_number']
+
+    def __init__(self, base_offset, config):
+        ExtCapabilityRegSet.__init__(self, "Device Serial Number Extended Capability", base_offset, 0x0003, config, "dsn")
+
+    def define(self):
+        ExtCapabilityRegSet.define(self)
+        self.add("dsn_serial_number_lower", 32, 0x04)
+        self.add("dsn_serial_number_upper", 32, 0x08)
+
+    def get_device_serial_number(self):
+        "The 64 bit serial number, the upper half is usually the vendor's OUI"
+        return (self.read("dsn_serial_number_upper") << 32) | self.read("dsn_serial_number_lower")
+
+
+ext_cap_types[0x000d] = lambda base_offset, config: ExtCapabilityACS(base_offset, config)
+class ExtCapabilityACS(ExtCapabilityRegSet):
+    def __init__(self, base_offset, config):
+        ExtCapabilityRegSet.__init__(self, "Access Control Services Extended Capability", base_offset, 0x000d, config, "acs")
+
+    def define(self):
+        ExtCapabilityRegSet.define(self)
+        self.add("acs_capability", 16, 0x04)
+        self.add("acs_capability_source_validation", 16, 0x04, bit_offset=0)
+        self.add("acs_capability_translation_blocking", 16, 0x04, bit_offset=1)
+        self.add("acs_capability_p2p_request_redirect", 16, 0x04, bit_offset=2)
+        self.add("acs_capability_p2p_completion_redirect", 16, 0x04, bit_offset=3)
+        self.add("acs_capability_upstream_forwarding", 16, 0x04, bit_offset=4)
+        self.add("acs_capability_p2p_egress_control", 16, 0x04, bit_offset=5)
+        self.add("acs_capability_direct_translated_p2p", 16, 0x04, bit_offset=6)
+        self.add("acs_capability_egress_control_vector_size", 16, 0x04, bit_offset=8, bit_length=8)
+
+        self.add("acs_control", 16, 0x06)
+        self.add("acs_control_source_validation_enable", 16, 0x06, bit_offset=0)
+        self.add("acs_control_translation_blocking_enable", 16, 0x06, bit_offset=1)
+        self.add("acs_control_p2p_request_redirect_enable", 16, 0x06, bit_offset=2)
+        self.add("acs_control_p2p_completion_redirect_enable", 16, 0x06, bit_offset=3)
+        self.add("acs_control_upstream_forwarding_enable", 16, 0x06, bit_offset=4)
+        self.add("acs_control_p2p_egress_control_enable", 16, 0x06, bit_offset=5)
+        self.add("acs_control_direct_translated_p2p_enable", 16, 0x06, bit_offset=6)
+
+
+ext_cap_types[0x0010] = lambda base_offset, config: ExtCapabilitySRIOV(base_offset, config)
+class ExtCapabilitySRIOV(ExtCapabilityRegSet):
+    def __init__(self, base_offset, config):
+        ExtCapabilityRegSet.__init__(self, "Single Root I/O Virtualization Extended Capability", base_offset, 0x0010, config, "sriov")
+
+    def define(self):
+        ExtCapabilityRegSet.define(self)
+        self.add("sriov_capabilities", 32, 0x04)
+        self.add("sriov_capabilities_vf_migration_capable", 32, 0x04, bit_offset=0)
+        self.add("sriov_capabilities_ari_capable_hierarchy_preserved", 32, 0x04, bit_offset=1)
+        self.add("sriov_capabilities_vf_migration_interrupt_message_number", 32, 0x04, bit_offset=21, bit_length=11)
+
+        self.add("sriov_control", 16, 0x08)
+        self.add("sriov_control_vf_enable", 16, 0x08, bit_offset=0)
+        self.add("sriov_control_vf_migration_enable", 16, 0x08, bit_offset=1)
+        self.add("sriov_control_vf_migration_interrupt_enable", 16, 0x08, bit_offset=2)
+        self.add("sriov_control_vf_mse", 16, 0x08, bit_offset=3)
+        self.add("sriov_control_ari_capable_hierarchy", 16, 0x08, bit_offset=4)
+
+        self.add("sriov_status", 16, 0x0a)
+        self.add("sriov_status_vf_migration_status", 16, 0x0a, bit_offset=0)
+
+        self.add("sriov_initial_vfs", 16, 0x0c)
+        self.add("sriov_total_vfs", 16, 0x0e)
+        self.add("sriov_num_vfs", 16, 0x10)
+        self.add("sriov_function_dependency_link", 8, 0x12)
+        self.add("sriov_first_vf_offset", 16, 0x14)
+        self.add("sriov_vf_stride", 16, 0x16)
+        self.add("sriov_vf_device_id", 16, 0x1a)
+        self.add("sriov_supported_page_sizes", 32, 0x1c)
+        self.add("sriov_system_page_size", 32, 0x20)
+        for i in range(6):
+            self.add("sriov_vf_bar%d" % (i), 32, 0x24 + i * 4)
+        self.add("sriov_vf_migration_state_array_offset", 32, 0x3c)
+
+
+# Up to six BARs, only the first rebar_control_0_number_of_resizable_bars
+# capability/control pairs are actually implemented
+ext_cap_types[0x0015] = lambda base_offset, config: ExtCapabilityResizableBAR(base_offset, config)
+class ExtCapabilityResizableBAR(ExtCapabilityRegSet):
+    # Capability/control register pairs follow the header, as many as the
+    # first control register says are implemented
+    max_bars = 6
+
+    def __init__(self, base_offset, config):
+        self.bars = self.max_bars
+        if config is not None:
+            bars = config.read(base_offset + 0x08, 32, bit_offset=5, bit_length=3)
+            self.bars = max(1, min(bars, self.max_bars))
+        ExtCapabilityRegSet.__init__(self, "Resizable BAR Extended Capability", base_offset, 0x0015, config, "rebar")
+
+    def layout_key(self):
+        return (self.__class__, self.name, self.bars)
+
+    def define(self):
+        ExtCapabilityRegSet.define(self)
+        for i in range(self.bars):
+            offset = 0x04 + i * 8
+            self.add("rebar_capability_%d" % (i), 32, offset)
+            self.add("rebar_capability_%d_supported_sizes" % (i), 32, offset, bit_offset=4, bit_length=28)
+            self.add("rebar_control_%d" % (i), 32, offset + 4)
+            self.add("rebar_control_%d_bar_index" % (i), 32, offset + 4, bit_offset=0, bit_length=3)
+            if i == 0:
+                self.add("rebar_control_0_number_of_resizable_bars", 32, offset + 4, bit_offset=5, bit_length=3)
+            self.add("rebar_control_%d_bar_size" % (i), 32, offset + 4, bit_offset=8, bit_length=6)
+
+
+ext_cap_types[0x0018] = lambda base_offset, config: ExtCapabilityLTR(base_offset, config)
+class ExtCapabilityLTR(ExtCapabilityRegSet):
+    def __init__(self, base_offset, config):
+        ExtCapabilityRegSet.__init__(self, "Latency Tolerance Reporting Extended Capability", base_offset, 0x0018, config, "ltr")
+
+    def define(self):
+        ExtCapabilityRegSet.define(self)
+        self.add("ltr_max_snoop_latency", 16, 0x04)
+        self.add("ltr_max_snoop_latency_value", 16, 0x04, bit_offset=0, bit_length=10)
+        self.add("ltr_max_snoop_latency_scale", 16, 0x04, bit_offset=10, bit_length=3)
+        self.add("ltr_max_no-snoop_latency", 16, 0x06)
+        self.add("ltr_max_no-snoop_latency_value", 16, 0x06, bit_offset=0, bit_length=10)
+        self.add("ltr_max_no-snoop_latency_scale", 16, 0x06, bit_offset=10, bit_length=3)
+
+
+def max_link_width(config):
+    "Maximum link width from the PCI Express capability, 0 if there isn't one"
+    caps, ext_caps = scan_capabilities(config.read_block(0, 0x100))
+    offset = first_offsets(caps).get(0x10)
+    if offset is None:
+        return 0
+    return config.read(offset + 0x0c, 32, bit_offset=4, bit_length=6)
+
+# One lane equalization control register per lane of the maximum link width,
+# only as many as the link has are implemented
+ext_cap_types[0x0019] = lambda base_offset, config: ExtCapabilitySecondaryPCIe(base_offset, config)
+class ExtCapabilitySecondaryPCIe(ExtCapabilityRegSet):
+    max_lanes = 32
+
+    def __init__(self, base_offset, config):
+        self.lanes = self.max_lanes
+        if config is not None:
+            self.lanes = min(max_link_width(config), self.max_lanes)
+        ExtCapabilityRegSet.__init__(self, "Secondary PCI Express Extended Capability", base_offset, 0x0019, config, "secondary_pcie")
+
+    def layout_key(self):
+        return (self.__class__, self.name, self.lanes)
+
+    def define(self):
+        ExtCapabilityRegSet.define(self)
+        self.add("secondary_pcie_link_control3", 32, 0x04)
+        self.add("secondary_pcie_link_control3_perform_equalization", 32, 0x04, bit_offset=0)
+        self.add("secondary_pcie_link_control3_link_equalization_request_interrupt_enable", 32, 0x04, bit_offset=1)
+        self.add("secondary_pcie_lane_error_status", 32, 0x08)
+        for i in range(self.lanes):
+            self.add("secondary_pcie_lane_equalization_control_%d" % (i), 16, 0x0c + i * 2)
+
+
+ext_cap_types[0x001e] = lambda base_offset, config: ExtCapabilityL1PMSubstates(base_offset, config)
+class ExtCapabilityL1PMSubstates(ExtCapabilityRegSet):
+    def __init__(self, base_offset, config):
+        ExtCapabilityRegSet.__init__(self, "L1 PM Substates Extended Capability", base_offset, 0x001e, config, "l1ss")
+
+    def define(self):
+        ExtCapabilityRegSet.define(self)
+        self.add("l1ss_capabilities", 32, 0x04)
+        self.add("l1ss_capabilities_pci_pm_l1_2_supported", 32, 0x04, bit_offset=0)
+        self.add("l1ss_capabilities_pci_pm_l1_1_supported", 32, 0x04, bit_offset=1)
+        self.add("l1ss_capabilities_aspm_l1_2_supported", 32, 0x04, bit_offset=2)
+        self.add("l1ss_capabilities_aspm_l1_1_supported", 32, 0x04, bit_offset=3)
+        self.add("l1ss_capabilities_l1_pm_substates_supported", 32, 0x04, bit_offset=4)
+        self.add("l1ss_capabilities_port_common_mode_restore_time", 32, 0x04, bit_offset=8, bit_length=8)
+        self.add("l1ss_capabilities_port_t_power_on_scale", 32, 0x04, bit_offset=16, bit_length=2)
+        self.add("l1ss_capabilities_port_t_power_on_value", 32, 0x04, bit_offset=19, bit_length=5)
+
+        self.add("l1ss_control1", 32, 0x08)
+        self.add("l1ss_control1_pci_pm_l1_2_enable", 32, 0x08, bit_offset=0)
+        self.add("l1ss_control1_pci_pm_l1_1_enable", 32, 0x08, bit_offset=1)
+        self.add("l1ss_control1_aspm_l1_2_enable", 32, 0x08, bit_offset=2)
+        self.add("l1ss_control1_aspm_l1_1_enable", 32, 0x08, bit_offset=3)
+        self.add("l1ss_control1_common_mode_restore_time", 32, 0x08, bit_offset=8, bit_length=8)
+        self.add("l1ss_control1_ltr_l1_2_threshold_value", 32, 0x08, bit_offset=16, bit_length=10)
+        self.add("l1ss_control1_ltr_l1_2_threshold_scale", 32, 0x08, bit_offset=29, bit_length=3)
+
+        self.add("l1ss_control2", 32, 0x0c)
+        self.add("l1ss_control2_t_power_on_scale", 32, 0x0c, bit_offset=0, bit_length=2)
+        self.add("l1ss_control2_t_power_on_value", 32, 0x0c, bit_offset=3, bit_length=5)
+
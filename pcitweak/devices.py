@@ -1,59 +1,97 @@
-import os, re
-from config import PCIConfigSpace, PCIConfigSpaceAccess
+import os, sys, re, collections, hashlib, json, threading, Queue
+from config import PCIConfigSpace, PCIConfigSpaceAccess, decode_reg, get_field, \
+     scan_capabilities, first_offsets, get_cap_type, get_ext_cap_type
+
+# xxxx:xx:xx.x, the domain is optional
+addr_re = re.compile("^(?:([0-9a-f]+):)?([0-9a-f]+):([0-9a-f]+)\.([0-9a-f]+)", re.I)
+dev_dir_re = re.compile("^[0-9a-f]+:[0-9a-f]+:[0-9a-f]+\.[0-9a-f]+$", re.I)
+root_dir_re = re.compile("^pci([0-9a-f]*):([0-9a-f]*)$", re.I)
+
+class PCIDeviceAddress(object):
+    """
+    Immutable (domain, bus, device, func) address.  It hashes and sorts in
+    address order, so it can be used as a dict or sort key.
+    """
+    __slots__ = ("domain", "bus", "device", "func")
 
-class PCIDeviceAddress:
     def __init__(self, domain=None, bus=None, device=None, func=None):
-        self.domain = domain
-        self.bus = bus
-        self.device = device
-        self.func = func
+        object.__setattr__(self, "domain", domain)
+        object.__setattr__(self, "bus", bus)
+        object.__setattr__(self, "device", device)
+        object.__setattr__(self, "func", func)
 
-    def __str__(self):
-        return "%04x:%02x:%02x.%x" % (self.domain, self.bus, self.device, self.func)
+    def __setattr__(self, name, value):
+        raise AttributeError("PCIDeviceAddress is immutable")
+
+    def __reduce__(self):
+        return (self.__class__, self._key())
+
+    def _key(self):
+        return (self.domain, self.bus, self.device, self.func)
 
     def __eq__(self, other):
-        if ( self.domain == other.domain and
-             self.bus == other.bus and
-             self.device == other.device and
-             self.func == other.func
-          ):
-            return True
-        else:
-            return False
+        if not isinstance(other, PCIDeviceAddress):
+            return NotImplemented
+        return self._key() == other._key()
 
     def __ne__(self, other):
-        if self.__eq__(other):
-            return False
-        else:
-            return True
+        if not isinstance(other, PCIDeviceAddress):
+            return NotImplemented
+        return self._key() != other._key()
+
+    def __lt__(self, other):
+        return self._key() < other._key()
+
+    def __le__(self, other):
+        return self._key() <= other._key()
+
+    def __gt__(self, other):
+        return self._key() > other._key()
+
+    def __ge__(self, other):
+        return self._key() >= other._key()
+
+    def __hash__(self):
+        return hash(self._key())
 
-    def parse(self, string, is_hex_not_decimal=True):
+    def __str__(self):
+        return "%04x:%02x:%02x.%x" % self._key()
+
+    def __repr__(self):
+        return "PCIDeviceAddress('%s')" % (str(self))
+
+    @property
+    def bdf(self):
+        "Packed 32 bit form, domain in the upper 16 bits then bus, device, function"
+        return (self.domain << 16) | (self.bus << 8) | (self.device << 3) | self.func
+
+    @classmethod
+    def from_bdf(cls, bdf):
+        return cls(bdf >> 16, (bdf >> 8) & 0xff, (bdf >> 3) & 0x1f, bdf & 0x7)
+
+    @classmethod
+    def parse(cls, string, is_hex_not_decimal=True):
+        "Parse the xxxx:xx:xx.x or xx:xx.x forms, returns a new address"
         if is_hex_not_decimal:
             base = 16
         else:
             base = 10
 
-        # xxxx:xx:xx.xx form
-        m = re.match("^([0-9a-f]*):([0-9a-f]*):([0-9a-f]*)\.([0-9a-f]*).*", string, re.I)
-        if m is not None:
-            self.domain = int(m.group(1), base)
-            self.bus = int(m.group(2), base)
-            self.device = int(m.group(3), base)
-            self.func = int(m.group(4), base)
-            return
+        m = addr_re.match(string)
+        if m is None:
+            raise ValueError("Provided PCI address '%s' is not parsable" % (string))
 
-        # xx:xx.xx form
-        m = re.match("^([0-9a-f]*):([0-9a-f]*)\.([0-9a-f]*).*", string, re.I)
-        if m is not None:
-            self.domain = 0
-            self.bus = int(m.group(1), base)
-            self.device = int(m.group(2), base)
-            self.func = int(m.group(3), base)
-            return
-    
-        raise ValueError("Provided PCI address '%s' is not parsable" % (string))
+        domain, bus, device, func = m.groups()
+        if domain is None:
+            domain = 0
+        else:
+            domain = int(domain, base)
+        return cls(domain, int(bus, base), int(device, base), int(func, base))
+
+# Encoded MaxPayload/MaxReadReq values, see PCIDevices.payload_limits()
+PayloadLimits = collections.namedtuple("PayloadLimits", ["subtree", "max_payload", "max_read_req"])
 
-class PCIDevice:
+class PCIDevice(object):
     def __init__(self, devices_parent=None):
         self.devices = devices_parent
         # If parent points to itself, it's a root device
@@ -65,77 +103,571 @@ class PCIDevice:
         self.device = None
         self.sub_vendor = None
         self.sub_device = None
-        self.config = None
+        self.class_code = None
+        # sysfs directory for the device, holds the config file
+        self.path = None
+        self._config = None
+        # Lazy discovery leaves the config space unparsed, it gets built
+        # the first time config is touched
+        self._config_pending = False
+        # Config space access opened by capability() before config was
+        # built, config takes it over
+        self._access = None
+
+    def _get_config(self):
+        if self._config_pending:
+            # Only stop trying once it's built, a failed first touch (device
+            # gone, no permission) raises again next time rather than
+            # leaving config None
+            self._config = self.devices._build_config(self)
+            self._config_pending = False
+        return self._config
+
+    def _set_config(self, config):
+        self._config = config
+        self._config_pending = False
+
+    config = property(_get_config, _set_config)
+
+    def capability(self, id, extended=False):
+        """
+        Register set for just this capability, None if the device doesn't
+        have it.  Until config is built only the capability lists are read,
+        none of the other register sets get built.
+        """
+        if not self._config_pending:
+            if self._config is None:
+                return None
+            return self._config.capability(id, extended)
+        if self._access is None:
+            self._access = self.devices._open_access(self)
+        caps = self.devices.cached_caps.get(self.addr)
+        if caps is None:
+            caps = scan_capabilities(self._access.read_block(0, self._access.size()))
+            self.devices.cached_caps[self.addr] = caps
+        if extended:
+            offset = first_offsets(caps[1]).get(id)
+            cap_type = get_ext_cap_type
+        else:
+            offset = first_offsets(caps[0]).get(id)
+            cap_type = get_cap_type
+        if offset is None:
+            return None
+        return cap_type(id, offset, self._access)
+
+    def is_virtfn(self):
+        "SR-IOV virtual function, sysfs links those to their physical function"
+        return self.path is not None and os.path.exists(os.path.join(self.path, "physfn"))
+
+    def _close(self):
+        if self._config is not None:
+            self._config.config.close()
+        elif self._access is not None:
+            self._access.close()
+        self._config = None
+        self._access = None
+        self._config_pending = False
 
 class PCIDevices:
-    def __init__(self):
+    def __init__(self, snapshot=False, lazy=False, threads=None, backend=None, cache=None,
+                 sysfs_root="/sys"):
+        """
+        snapshot: read each device's whole config space in one go and serve
+                  register reads from that copy, see PCIConfigSpace.refresh()
+        lazy:     only read the IDs at discovery, open and parse each device's
+                  config space the first time dev.config is used
+        threads:  discover the subtrees under each root complex in parallel
+                  on a pool of at most this many threads
+        backend:  called with each PCIDevice to get the config space backend
+                  to use, ex: lambda dev: ecam_backend(dev.addr), defaults
+                  to the sysfs config file
+        cache:    file to keep the discovered tree and capability offsets
+                  in, reused for as long as the boot and the list of devices
+                  in sysfs stay the same.  Devices loaded from it only open
+                  their config space when it's used.
+        sysfs_root: where sysfs is mounted, ex: a generated tree to run
+                    against without the hardware, see benchmarks/
+        """
         self.devices = []
+        self.snapshot = snapshot
+        self.lazy = lazy
+        self.threads = threads
+        self.backend = backend
+        self.cache = cache
+        self.sysfs_root = sysfs_root
+        # addr -> (caps, ext_caps) loaded from the cache or found by
+        # PCIDevice.capability()
+        self.cached_caps = {}
+        # See payload_limits()
+        self._payload_limits = None
+        # attr -> {value: [devices]}, see _index_add()
+        self.index = {}
+        for attr in self.index_attrs:
+            self.index[attr] = {}
         self.discover()
 
-    def _discover__build_device(self, dir_parent, dir_dev, device_parent):
-        if not re.match("^([0-9a-f]*):([0-9a-f]*):([0-9a-f]*)\.([0-9a-f]*)$", dir_dev, re.I):
+    # Attributes get() looks up through a hash index instead of scanning,
+    # vendor and device together also get a combined index
+    index_attrs = ["vendor", "device", ("vendor", "device"), "sub_vendor",
+                   "sub_device", "addr", "class_code"]
+
+    def _index_key(self, attr, value):
+        if attr == "addr" and isinstance(value, basestring):
+            return PCIDeviceAddress.parse(value)
+        return value
+
+    def _index_value(self, dev, attr):
+        if isinstance(attr, tuple):
+            return tuple([getattr(dev, a) for a in attr])
+        return self._index_key(attr, getattr(dev, attr))
+
+    def _index_add(self, dev):
+        for attr in self.index_attrs:
+            self.index[attr].setdefault(self._index_value(dev, attr), []).append(dev)
+
+    def _index_remove(self, dev):
+        for attr in self.index_attrs:
+            key = self._index_value(dev, attr)
+            devs = self.index[attr][key]
+            devs.remove(dev)
+            if not devs:
+                del self.index[attr][key]
+
+    def _open_access(self, dev):
+        "Config space access for dev, the sources other than sysfs override this"
+        filename = os.path.join(dev.path, "config")
+        backend = None
+        if self.backend is not None:
+            backend = self.backend(dev)
+        return PCIConfigSpaceAccess(filename, dev, self.snapshot, backend)
+
+    def read_image(self, dev):
+        """
+        Raw config space of dev, None if it has none.  Goes through the
+        access dev already has open or opens one just for the read, nothing
+        gets parsed.
+        """
+        if dev._config_pending:
+            access = dev._access
+        elif dev._config is not None:
+            access = dev._config.config
+        else:
             return None
+        if access is not None:
+            return access.read_block(0, access.size())
+        access = self._open_access(dev)
+        try:
+            return access.read_block(0, access.size())
+        finally:
+            access.close()
+
+    def _build_config(self, dev):
+        access = dev._access
+        if access is None:
+            access = self._open_access(dev)
+        config = PCIConfigSpace(access, self.cached_caps.get(dev.addr))
+        dev._access = None
+        # Copy addr into config for error messages
+        config.addr = dev.addr
+        return config
 
+    # sysfs attribute file -> PCIDevice attribute
+    id_attrs = [
+        ("vendor", "vendor"),
+        ("device", "device"),
+        ("subsystem_vendor", "sub_vendor"),
+        ("subsystem_device", "sub_device"),
+        ("class", "class_code"),
+    ]
+
+    def _discover__read_ids(self, dev):
+        """
+        Fill in the IDs from the sysfs attribute files, this doesn't touch the
+        config space (or need root).  Falls back to one read of the header if
+        the attributes aren't there.
+        """
+        try:
+            for fn, attr in self.id_attrs:
+                f = open(os.path.join(dev.path, fn))
+                try:
+                    setattr(dev, attr, int(f.read(), 16))
+                finally:
+                    f.close()
+            return
+        except IOError:
+            pass
+
+        # Unprivileged reads of config only return the first 64 bytes, which
+        # covers everything needed here
+        f = open(os.path.join(dev.path, "config"), 'rb')
+        try:
+            header = f.read(0x30)
+        finally:
+            f.close()
+        self._discover__header_ids(dev, header)
+
+    def _discover__header_ids(self, dev, header):
+        "Fill in the IDs from the first 0x30 bytes of config space"
+        dev.vendor = decode_reg(header, 0x00, 16)
+        dev.device = decode_reg(header, 0x02, 16)
+        dev.class_code = decode_reg(header, 0x09, 24)
+        if get_field(decode_reg(header, 0x0e, 8), 0, 7) == 0:
+            dev.sub_vendor = decode_reg(header, 0x2c, 16)
+            dev.sub_device = decode_reg(header, 0x2e, 16)
+
+    def _discover__build_device(self, dir_parent, dir_dev, device_parent, found):
+        """
+        Build the device in dir_dev and everything below it, devices are added
+        to found in the order they're completed
+        """
         dir_full = os.path.join(dir_parent, dir_dev)
 
         dev = PCIDevice(devices_parent=self)
 
-        dev.addr.parse(dir_dev)
+        dev.addr = PCIDeviceAddress.parse(dir_dev)
         dev.parent = device_parent
 
         filename = os.path.join(dir_full, "config")
         if not os.path.exists(filename):
-            print "Warning: no config space file for device %s" % (dev.addr)
+            print "Warning: no config space file for device %s" % (str(dev.addr))
             return None
 
-        dev.config = PCIConfigSpace(PCIConfigSpaceAccess(filename, dev))
-        # Copy addr into config for error messages
-        dev.config.addr = dev.addr
-        
-        dev.device = dev.config.read("common_device_id")
-        dev.vendor = dev.config.read("common_vendor_id")
-        if "type0_subsystem_vendor_id" in dev.config:
-            dev.sub_vendor = dev.config.read("type0_subsystem_vendor_id")
-            dev.sub_device = dev.config.read("type0_subsystem_id")
+        dev.path = dir_full
+        self._discover__read_ids(dev)
+        if self.lazy:
+            dev._config_pending = True
+        else:
+            dev.config = self._build_config(dev)
         
         for filename in os.listdir(dir_full):
-            newdev = self._discover__build_device(dir_full, filename, dev)
+            if not dev_dir_re.match(filename):
+                continue
+            newdev = self._discover__build_device(dir_full, filename, dev, found)
             if newdev is not None:
                 dev.children.append(newdev)
 
-        self.devices.append(dev)
+        found.append(dev)
         return dev
+
+    def _discover__build_subtree(self, dirs):
+        found = []
+        dev = self._discover__build_device(dirs[0], dirs[1], None, found)
+        return dev, found
         
+    def _discover__worker(self, work, built, errors):
+        while not errors:
+            try:
+                i, dirs = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                built[i] = self._discover__build_subtree(dirs)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    def _discover__threaded(self, subtrees):
+        """
+        Build the subtrees on up to self.threads plain threads pulling from a
+        queue, results in subtrees order.  A ThreadPool costs ~100ms to shut
+        down on python 2, more than most trees take to build.
+        """
+        work = Queue.Queue()
+        for i, dirs in enumerate(subtrees):
+            work.put((i, dirs))
+        built = [None] * len(subtrees)
+        errors = []
+        threads = []
+        for i in range(min(self.threads, len(subtrees))):
+            t = threading.Thread(target=self._discover__worker, args=(work, built, errors))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if errors:
+            exc_type, exc_value, tb = errors[0]
+            raise exc_type, exc_value, tb
+        return built
+
+    def discover(self):
+        key = None
+        if self.cache is not None:
+            key = self._cache__key()
+            if key is not None and self._cache__load(key):
+                return
+        self._discover__sysfs()
+        if key is not None:
+            self.save_cache(key)
+
     # When porting, this and it's children should be the only areas
     # in this file that needs work
-    def discover(self):
-        basedir = "/sys/devices"
+    def _discover__sysfs(self):
+        basedir = os.path.join(self.sysfs_root, "devices")
         
-        # Find all directories matching pciX:Y, then look for a subdirectoriy X:Y:00.0
+        # Find all directories matching pciX:Y, each device directory directly
+        # under one of those is a subtree that can be built on its own
+        root_complexes = []
+        subtrees = []
         devices_subdirs = os.listdir(basedir)
         for device_subdir in devices_subdirs:
-            m = re.match("^pci([0-9a-f]*):([0-9a-f]*)$", device_subdir, re.I)
+            m = root_dir_re.match(device_subdir)
             if m is not None:
-                root_addr = PCIDeviceAddress()
-                root_addr.domain = int(m.group(1), 16)
-                root_addr.bus = int(m.group(2), 16)
-                root_addr.device = 0
-                root_addr.func = 0
-
+                root_addr = PCIDeviceAddress(int(m.group(1), 16), int(m.group(2), 16), 0, 0)
                 device_full_dir = os.path.join(basedir, device_subdir)
-                root_dev = None
+                first = len(subtrees)
                 for child_dev_dir in os.listdir(device_full_dir):
-                    newdev = self._discover__build_device(device_full_dir, child_dev_dir, None)
-                    if newdev is not None:
-                        if newdev.addr == root_addr:
-                            root_dev = newdev
-                            root_dev.parent = root_dev
-                            root_dev.is_root = True
-                    
-                for dev in self.devices:
-                    if dev.parent is None:
-                        dev.parent = root_dev
+                    if dev_dir_re.match(child_dev_dir):
+                        subtrees.append((device_full_dir, child_dev_dir))
+                root_complexes.append((root_addr, first, len(subtrees)))
+
+        if self.threads is not None and self.threads > 1 and len(subtrees) > 1:
+            built = self._discover__threaded(subtrees)
+        else:
+            built = map(self._discover__build_subtree, subtrees)
+
+        # Merge in directory order so the result doesn't depend on threading
+        for root_addr, first, last in root_complexes:
+            root_dev = None
+            for newdev, found in built[first:last]:
+                for dev in found:
+                    self.devices.append(dev)
+                    self._index_add(dev)
+                if newdev is not None:
+                    if newdev.addr == root_addr:
+                        root_dev = newdev
+                        root_dev.parent = root_dev
+                        root_dev.is_root = True
+
+            for dev in self.devices:
+                if dev.parent is None:
+                    dev.parent = root_dev
         
+    cache_version = 1
+
+    # sysfs attribute files that go into the cache fingerprint, a different
+    # card in the same slot changes them
+    cache_id_attrs = ["vendor", "device", "class"]
+
+    def _cache__key(self):
+        """
+        (boot id, fingerprint of the devices sysfs lists, where they sit in
+        the tree and their IDs), None if any of it can't be read
+        """
+        devdir = os.path.join(self.sysfs_root, "bus", "pci", "devices")
+        try:
+            f = open("/proc/sys/kernel/random/boot_id")
+            try:
+                boot_id = f.read().strip()
+            finally:
+                f.close()
+            fingerprint = hashlib.sha1()
+            for name in sorted(os.listdir(devdir)):
+                fingerprint.update("%s %s" % (name, os.readlink(os.path.join(devdir, name))))
+                for attr in self.cache_id_attrs:
+                    f = open(os.path.join(devdir, name, attr))
+                    try:
+                        fingerprint.update(" " + f.read().strip())
+                    finally:
+                        f.close()
+                fingerprint.update("\n")
+        except (IOError, OSError):
+            return None
+        return [boot_id, fingerprint.hexdigest()]
+
+    def _cache__load(self, key):
+        "Rebuild the tree from the cache, False if it's missing or stale"
+        try:
+            f = open(self.cache)
+            try:
+                cached = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return False
+        if cached.get("version") != self.cache_version or cached.get("key") != key:
+            return False
+
+        byaddr = {}
+        for entry in cached["devices"]:
+            dev = PCIDevice(devices_parent=self)
+            dev.addr = PCIDeviceAddress.parse(entry["addr"])
+            dev.path = entry["path"]
+            dev.vendor, dev.device, dev.sub_vendor, dev.sub_device, dev.class_code = entry["ids"]
+            dev.is_root = entry["root"]
+            dev._config_pending = True
+            if entry["caps"] is not None:
+                self.cached_caps[dev.addr] = ([tuple(c) for c in entry["caps"]],
+                                              [tuple(c) for c in entry["ext_caps"]])
+            self.devices.append(dev)
+            self._index_add(dev)
+            byaddr[entry["addr"]] = dev
+
+        self._load__link(byaddr, [(entry["parent"], entry["child"]) for entry in cached["devices"]])
+        return True
+
+    def _load__link(self, byaddr, links):
+        """
+        Rebuild the tree of devices loaded from a saved list, links has
+        (parent key in byaddr or None, listed in the parent's children) for
+        each of self.devices
+        """
+        # Children were saved in order, so appending rebuilds the same lists
+        for dev, (parent, child) in zip(self.devices, links):
+            if parent is not None:
+                dev.parent = byaddr[parent]
+                if child:
+                    dev.parent.children.append(dev)
+
+    def save_cache(self, key=None):
+        """
+        Write the tree to the cache file, with the capability offsets of
+        every device whose config space has been parsed so far
+        """
+        if key is None:
+            key = self._cache__key()
+            if key is None:
+                return
+
+        devices = []
+        for dev in self.devices:
+            caps = ext_caps = None
+            if dev._config is not None:
+                caps, ext_caps = dev._config.caps, dev._config.ext_caps
+            elif dev.addr in self.cached_caps:
+                caps, ext_caps = self.cached_caps[dev.addr]
+            parent = None
+            if dev.parent is not None:
+                parent = str(dev.parent.addr)
+            devices.append({
+                "addr": str(dev.addr),
+                "path": dev.path,
+                "ids": [dev.vendor, dev.device, dev.sub_vendor, dev.sub_device, dev.class_code],
+                "root": dev.is_root,
+                "parent": parent,
+                "child": dev.parent is not None and dev in dev.parent.children,
+                "caps": caps,
+                "ext_caps": ext_caps,
+            })
+
+        # Write and rename so a reader never sees half a file
+        tmp = "%s.%d" % (self.cache, os.getpid())
+        f = open(tmp, "w")
+        try:
+            json.dump({"version": self.cache_version, "key": key, "devices": devices}, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.cache)
+
+    def _rescan__list(self, dir_full, parent_addr, found):
+        for filename in os.listdir(dir_full):
+            if dev_dir_re.match(filename):
+                addr = PCIDeviceAddress.parse(filename)
+                found.append((addr, dir_full, filename, parent_addr))
+                self._rescan__list(os.path.join(dir_full, filename), addr, found)
+
+    def _rescan__remove(self, dev):
+        self.devices.remove(dev)
+        self._index_remove(dev)
+        if dev.parent is not None and dev.parent is not dev and dev in dev.parent.children:
+            dev.parent.children.remove(dev)
+        dev._close()
+        # Whatever shows up at this address next may not look the same
+        self.cached_caps.pop(dev.addr, None)
+
+    def rescan(self):
+        """
+        Bring the tree up to date with sysfs after hot plug, SR-IOV VFs being
+        created or removed, etc.  Only new functions are built, removed ones
+        are dropped and their config space closed, everything else (config
+        space objects included) is kept.  Returns (added, removed) devices.
+        """
+        basedir = os.path.join(self.sysfs_root, "devices")
+
+        # (addr, parent directory, directory, parent addr) parents first,
+        # parent addr is None for devices directly under a root complex
+        found = []
+        root_addrs = {}
+        for device_subdir in os.listdir(basedir):
+            m = root_dir_re.match(device_subdir)
+            if m is not None:
+                root_addr = PCIDeviceAddress(int(m.group(1), 16), int(m.group(2), 16), 0, 0)
+                first = len(found)
+                self._rescan__list(os.path.join(basedir, device_subdir), None, found)
+                for entry in found[first:]:
+                    root_addrs[entry[0]] = root_addr
+
+        current = {}
+        for dev in self.devices:
+            current[dev.addr] = dev
+        found_addrs = set([entry[0] for entry in found])
+
+        removed = [dev for dev in self.devices if dev.addr not in found_addrs]
+        for dev in removed:
+            self._rescan__remove(dev)
+            del current[dev.addr]
+
+        added = []
+        for addr, dir_parent, dir_dev, parent_addr in found:
+            if addr in current:
+                continue
+            if parent_addr is not None and parent_addr not in current:
+                # Built along with its parent, or under one without config
+                continue
+
+            if parent_addr is None:
+                parent = None
+            else:
+                parent = current[parent_addr]
+            built = []
+            newdev = self._discover__build_device(dir_parent, dir_dev, parent, built)
+            if newdev is None:
+                continue
+            if parent is not None:
+                parent.children.append(newdev)
+            else:
+                root_addr = root_addrs[addr]
+                if newdev.addr == root_addr:
+                    newdev.parent = newdev
+                    newdev.is_root = True
+                else:
+                    root_dev = current.get(root_addr)
+                    if root_dev is not None and root_dev.is_root:
+                        newdev.parent = root_dev
+
+            for dev in built:
+                self.devices.append(dev)
+                self._index_add(dev)
+                current[dev.addr] = dev
+            added.extend(built)
+
+        # A new root complex's root may have come after its other devices
+        for dev in added:
+            if dev.parent is None:
+                root_dev = current.get(root_addrs[dev.addr])
+                if root_dev is not None and root_dev.is_root:
+                    dev.parent = root_dev
+
+        if added or removed:
+            self._payload_limits = None
+        return added, removed
+
+    def close(self):
+        "Close every device's config space, the devices can't be used after"
+        for dev in self.devices:
+            dev._close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def save(self, filename):
+        "Save every device's config space to an archive, see archive.py"
+        # archive builds on this module, so only pull it in here
+        from archive import save_archive
+        save_archive(self, filename)
+
     def roots(self):
         ret = []
         for d in self.devices:
@@ -144,17 +676,113 @@ class PCIDevices:
         return ret
 
     def get(self, **args):
-        ret = self.devices
+        """
+        Return the devices whose attributes match all of the given values,
+        ex: get(vendor=0x15b3, device=0x1003)
+        """
+        if "vendor" in args and "device" in args:
+            args[("vendor", "device")] = (args.pop("vendor"), args.pop("device"))
+
+        matches = []
+        for k in args.keys():
+            if k in self.index:
+                v = args.pop(k)
+                matches.append(self.index[k].get(self._index_key(k, v), []))
+
+        if matches:
+            # Intersect starting from the smallest match, which keeps the
+            # discovery order
+            matches.sort(key=len)
+            ret = matches[0]
+            for other in matches[1:]:
+                other = set(other)
+                ret = [d for d in ret if d in other]
+        else:
+            ret = self.devices
+
+        # Anything not indexed falls back to a scan
         for k, v in args.iteritems():
-            ret = [d for d in ret if d.__dict__[k] == v ]
-        return ret
+            ret = [d for d in ret if getattr(d, k) == v ]
+        return list(ret)
             
+    def hierarchies(self, select=None):
+        """
+        The top device of each hierarchy, the ones hanging directly off a root
+        complex.  With select, only the hierarchies holding those devices.
+        """
+        if select is None:
+            return [d for d in self.devices
+                    if not d.is_root and (d.parent is None or d.parent.is_root)]
+
+        ret = []
+        for dev in select:
+            top = None
+            for d in self.walk_to_root(dev):
+                if d.is_root:
+                    break
+                top = d
+                if d.parent is None:
+                    break
+            if top is not None and top not in ret:
+                ret.append(top)
+        return ret
+
+    def _payload_limits__visit(self, dev, subtree, found):
+        limit = None
+        for child in dev.children:
+            child_limit = self._payload_limits__visit(child, subtree, found)
+            if child_limit is not None and (limit is None or child_limit < limit):
+                limit = child_limit
+
+        config = dev.config
+        if config is not None and config.has_capability(0x10):
+            supported = config.read("pcie_device_capabilities_max_payload_size_supported")
+            if limit is None or supported < limit:
+                limit = supported
+            subtree[dev.addr] = limit
+            found.append(dev)
+        return limit
+
+    def payload_limits(self, refresh=False):
+        """
+        Safe MaxPayload and MaxReadReq for every PCIe device, as
+        {addr: PayloadLimits}, all values are the register encodings:
+
+        subtree:      largest MPS everything below and including dev supports
+        max_payload:  largest MPS every device in dev's hierarchy supports,
+                      what dev has to be set to
+        max_read_req: same as max_payload, so no completion is bigger than
+                      the hierarchy can carry
+
+        Computed in one post-order pass over children with each device's
+        supported MPS read once, kept until refresh.
+        """
+        if self._payload_limits is not None and not refresh:
+            return self._payload_limits
+
+        limits = {}
+        for top in self.hierarchies():
+            subtree = {}
+            found = []
+            max_payload = self._payload_limits__visit(top, subtree, found)
+            for dev in found:
+                limits[dev.addr] = PayloadLimits(subtree[dev.addr], max_payload, max_payload)
+        self._payload_limits = limits
+        return limits
+
     def walk_to_root(self, dev):
         yield dev
         while dev.parent is not dev:
             dev = dev.parent
             yield dev
 
+    def walk_subtree(self, dev):
+        "dev and everything below it, parents before children"
+        yield dev
+        for child in dev.children:
+            for d in self.walk_subtree(child):
+                yield d
+
     def walk_from_root(self, dev):
         dev_list = list(self.walk_to_root(dev))
         dev_list.reverse()
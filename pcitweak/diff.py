@@ -0,0 +1,103 @@
+"""
+Config space diffs
+
+Compares two raw config space images word by word and only decodes the named
+registers covering the bytes that changed, found through the register set's
+offset index:
+
+    before = dev.config.config.read_block(0, 4096)
+    ... tune ...
+    after = dev.config.config.read_block(0, 4096)
+    for change in diff(before, after, dev.config):
+        print change
+"""
+
+import struct
+from config import decode_reg, get_field
+
+# Bytes compared as a whole before dropping down to words
+DIFF_BLOCK = 64
+
+class FieldChange:
+    def __init__(self, reg, offset, old, new):
+        self.reg = reg
+        self.name = reg.name
+        # Absolute offset of the register
+        self.offset = offset
+        self.old = old
+        self.new = new
+
+    def __str__(self):
+        return "%s (0x%03x) 0x%x -> 0x%x" % (self.name, self.offset, self.old, self.new)
+
+def changed_words(old, new):
+    "Offsets of the 32 bit words that differ, over the length both cover"
+    length = min(len(old), len(new)) & ~0x3
+    ret = []
+    if old[:length] == new[:length]:
+        return ret
+    for block in range(0, length, DIFF_BLOCK):
+        end = min(block + DIFF_BLOCK, length)
+        if old[block:end] == new[block:end]:
+            continue
+        count = (end - block) / 4
+        old_words = struct.unpack_from("<%dI" % (count), old, block)
+        new_words = struct.unpack_from("<%dI" % (count), new, block)
+        for i in range(count):
+            if old_words[i] != new_words[i]:
+                ret.append(block + i * 4)
+    return ret
+
+def diff(old, new, regset):
+    """
+    FieldChanges for every register of regset (a device's PCIConfigSpace,
+    which knows where its capabilities are) whose value differs between the
+    old and new images, in offset order
+    """
+    index = regset.offset_index()
+    length = min(len(old), len(new))
+    seen = set()
+    # (offset, length) -> (old, new), bit fields share their register's decode
+    values = {}
+    ret = []
+    for word in changed_words(old, new):
+        for byte in range(word, word + 4):
+            if old[byte] == new[byte]:
+                continue
+            for reg, offset in index.lookup(byte):
+                if (reg, offset) in seen:
+                    continue
+                seen.add((reg, offset))
+
+                key = (offset, reg.length)
+                pair = values.get(key)
+                if pair is None:
+                    if offset + reg.length / 8 > length:
+                        continue
+                    pair = values[key] = (decode_reg(old, offset, reg.length), decode_reg(new, offset, reg.length))
+                old_value, new_value = pair
+                if reg.bit_offset is not None:
+                    old_value = get_field(old_value, reg.bit_offset, reg.bit_length)
+                    new_value = get_field(new_value, reg.bit_offset, reg.bit_length)
+                if old_value != new_value:
+                    ret.append(FieldChange(reg, offset, old_value, new_value))
+    ret.sort(key=lambda c: c.offset)
+    return ret
+
+def diff_devices(old_devices, new_devices):
+    """
+    {addr: [FieldChange]} for the devices in both, ex: a saved archive
+    against the live devices to find drift
+    """
+    ret = {}
+    for dev in new_devices.devices:
+        old = old_devices.get(addr=dev.addr)
+        if not old or old[0].config is None or dev.config is None:
+            continue
+        old_access = old[0].config.config
+        new_access = dev.config.config
+        changes = diff(old_access.read_block(0, old_access.size()),
+                       new_access.read_block(0, new_access.size()), dev.config)
+        if changes:
+            ret[dev.addr] = changes
+    return ret
@@ -0,0 +1,150 @@
+"""
+Link health monitor
+
+Samples link state and error status of a set of devices on a fixed interval
+without rediscovering anything between polls:
+
+    dl = PCIDevices(lazy=True)
+    mon = Monitor(dl, dl.get(vendor=0x15b3))
+    for sample in mon.samples(interval=1.0):
+        print sample.time, sample.addr, sample.values
+
+Each device's fields are worked out once up front.  A poll is then one read
+of the span of config space covering all of them, through the device's open
+backend, decoded in place.  A device that can't be read (unplugged, short
+read) gets a Sample with values None and the error, the others carry on.
+"""
+
+import time, struct, collections
+from config import reg_codecs, decode_reg
+
+default_fields = [
+    "pcie_link_status_link_speed",
+    "pcie_link_status_negotiated_link_width",
+    "pcie_device_status_correctable_error_detected",
+    "pcie_device_status_non-fatal_error_detected",
+    "pcie_device_status_fatal_error_detected",
+    "pcie_device_status_unsupported_request_detected",
+    # Only on devices with AER
+    "aer_uncorrectable_error_status",
+    "aer_correctable_error_status",
+]
+
+# error is None, or the exception reading the device raised and values None
+Sample = collections.namedtuple("Sample", ["time", "addr", "values", "error"])
+
+class DeviceSampler:
+    "One device's fields, read as a single span of config space"
+    def __init__(self, dev, fields):
+        self.dev = dev
+        self.backend = dev.config.config.backend
+
+        found = []
+        for name in fields:
+            if name not in dev.config:
+                continue
+            reg, part = dev.config.regs_byname[name]
+            found.append((name, reg, dev.config.bases[part] + reg.offset))
+
+        self.start = 0
+        self.nbytes = 0
+        # (offset in span, length) of each register, fields sharing a
+        # register only decode it once
+        self.regs = []
+        # (name, index into regs, bit offset, mask)
+        self.fields = []
+        if not found:
+            return
+
+        self.start = min([offset for name, reg, offset in found])
+        self.nbytes = max([offset + reg.length / 8 for name, reg, offset in found]) - self.start
+        regs = {}
+        for name, reg, offset in found:
+            key = (offset - self.start, reg.length)
+            if key not in regs:
+                regs[key] = len(self.regs)
+                self.regs.append(key)
+            if reg.bit_offset is None:
+                self.fields.append((name, regs[key], 0, (1 << reg.length) - 1))
+            else:
+                self.fields.append((name, regs[key], reg.bit_offset, (1 << reg.bit_length) - 1))
+
+    def sample(self):
+        "{field: value}, straight from the device even if config is snapshotted"
+        if not self.fields:
+            return {}
+        data = self.backend.read(self.start, self.nbytes)
+        if len(data) < self.nbytes:
+            raise IOError("Short read of %d bytes at 0x%x from %s" % (len(data), self.start, self.dev.addr))
+        values = []
+        for offset, length in self.regs:
+            codec = reg_codecs.get(length)
+            if codec is not None:
+                values.append(codec.unpack_from(data, offset)[0])
+            else:
+                values.append(decode_reg(data, offset, length))
+
+        ret = {}
+        for name, index, bit_offset, mask in self.fields:
+            ret[name] = (values[index] >> bit_offset) & mask
+        return ret
+
+class Monitor:
+    def __init__(self, devices, select=None, fields=None):
+        """
+        devices: the PCIDevices to watch
+        select:  devices to sample, defaults to every one with a config space
+        fields:  register or field names, defaults to default_fields, any a
+                 device doesn't have are skipped for it
+        """
+        if select is None:
+            select = devices.devices
+        if fields is None:
+            fields = default_fields
+        self.devices = devices
+        self.samplers = []
+        for dev in select:
+            if dev.config is None:
+                continue
+            sampler = DeviceSampler(dev, fields)
+            if sampler.fields:
+                self.samplers.append(sampler)
+
+    def poll(self):
+        "One Sample per device, all stamped with the same time"
+        now = time.time()
+        samples = []
+        for sampler in self.samplers:
+            try:
+                samples.append(Sample(now, sampler.dev.addr, sampler.sample(), None))
+            except (EnvironmentError, struct.error), e:
+                samples.append(Sample(now, sampler.dev.addr, None, e))
+        return samples
+
+    def samples(self, interval=1.0, count=None):
+        """
+        Poll every interval seconds, count times or forever, yielding each
+        Sample.  Polls are scheduled off the start time so slow ones don't
+        make the series drift.
+        """
+        next_poll = time.time()
+        polls = 0
+        while True:
+            for sample in self.poll():
+                yield sample
+            polls += 1
+            if count is not None and polls >= count:
+                return
+
+            next_poll += interval
+            delay = next_poll - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Fell behind, skip the missed polls rather than bursting
+                next_poll = time.time()
+
+    def run(self, callback, interval=1.0, count=None):
+        "samples(), passing each one to callback"
+        for sample in self.samples(interval, count):
+            callback(sample)
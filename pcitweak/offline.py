@@ -0,0 +1,145 @@
+"""
+Offline devices
+
+PCIDevices rebuilt from saved config space images instead of sysfs, no
+hardware or root needed.  The tree comes from the bridges' secondary bus
+numbers.
+
+    dl = PCIOfflineDevices.from_lspci("host1.lspci")    # lspci -D -xxxx
+    dl = PCIOfflineDevices.from_directory("host1/")     # one file per device
+"""
+
+import os, re, binascii
+from config import PCIConfigSpaceAccess, BufferConfigBackend, decode_reg, get_field
+from devices import PCIDevices, PCIDevice, PCIDeviceAddress, addr_re
+
+# "00: 86 80 37 12 ...", one line of an lspci -x hex dump
+dump_line_re = re.compile("^[0-9a-f]+: ((?:[0-9a-f]{2} ?)+)\s*$", re.I)
+
+def parse_lspci(lines):
+    "{addr: config space} from the output of lspci -x, -xxx or -xxxx"
+    images = {}
+    addr = None
+    chunks = []
+    for line in lines:
+        m = dump_line_re.match(line)
+        if m is not None:
+            if addr is not None:
+                chunks.append(m.group(1))
+            continue
+
+        m = addr_re.match(line)
+        if m is not None:
+            if addr is not None:
+                images[addr] = binascii.unhexlify("".join(chunks).replace(" ", ""))
+            addr = PCIDeviceAddress.parse(line)
+            chunks = []
+
+    if addr is not None:
+        images[addr] = binascii.unhexlify("".join(chunks).replace(" ", ""))
+    return images
+
+def read_image_dir(dirname):
+    """
+    {addr: config space} from a directory holding a file per device named by
+    address (0000:00:01.0 or 0000:00:01.0.bin), or a copy of the sysfs
+    device directories with a config file in each
+    """
+    images = {}
+    for fn in os.listdir(dirname):
+        m = addr_re.match(fn)
+        if m is None:
+            continue
+        filename = os.path.join(dirname, fn)
+        if os.path.isdir(filename):
+            filename = os.path.join(filename, "config")
+            if not os.path.exists(filename):
+                continue
+        f = open(filename, 'rb')
+        try:
+            images[PCIDeviceAddress.parse(fn)] = f.read()
+        finally:
+            f.close()
+    return images
+
+class PCIOfflineDevices(PCIDevices):
+    """
+    PCIDevices built from {addr: config space} images, config space is read
+    only and served from the images
+    """
+    def __init__(self, images, snapshot=False, lazy=True):
+        self.images = images
+        PCIDevices.__init__(self, snapshot=snapshot, lazy=lazy)
+
+    @classmethod
+    def from_lspci(cls, filename, **args):
+        f = open(filename)
+        try:
+            images = parse_lspci(f)
+        finally:
+            f.close()
+        return cls(images, **args)
+
+    @classmethod
+    def from_directory(cls, dirname, **args):
+        return cls(read_image_dir(dirname), **args)
+
+    def _offline__post_order(self, dev, found):
+        for child in dev.children:
+            self._offline__post_order(child, found)
+        found.append(dev)
+
+    def discover(self):
+        addrs = sorted(self.images)
+        devs = {}
+        # (domain, secondary bus) -> the bridge to it
+        bridges = {}
+        for addr in addrs:
+            image = self.images[addr]
+            dev = PCIDevice(devices_parent=self)
+            dev.addr = addr
+            self._discover__header_ids(dev, image[:0x30])
+            devs[addr] = dev
+
+            if len(image) > 0x19 and get_field(decode_reg(image, 0x0e, 8), 0, 7) == 1:
+                secondary = decode_reg(image, 0x19, 8)
+                if secondary > addr.bus:
+                    bridges.setdefault((addr.domain, secondary), dev)
+
+        # Devices not behind a bridge hang off their root complex, which like
+        # sysfs discovery is the function at device 0 on that bus
+        tops = []
+        for addr in addrs:
+            dev = devs[addr]
+            bridge = bridges.get((addr.domain, addr.bus))
+            if bridge is not None:
+                dev.parent = bridge
+                bridge.children.append(dev)
+            else:
+                tops.append(dev)
+
+        found = []
+        for dev in tops:
+            root_addr = PCIDeviceAddress(dev.addr.domain, dev.addr.bus, 0, 0)
+            if dev.addr == root_addr:
+                dev.parent = dev
+                dev.is_root = True
+            else:
+                dev.parent = devs.get(root_addr)
+            self._offline__post_order(dev, found)
+
+        for dev in found:
+            if self.lazy:
+                dev._config_pending = True
+            else:
+                dev.config = self._build_config(dev)
+            self.devices.append(dev)
+            self._index_add(dev)
+
+    def _open_access(self, dev):
+        image = self.images[dev.addr]
+        backend = BufferConfigBackend(image, 0, len(image))
+        return PCIConfigSpaceAccess(None, dev, self.snapshot, backend)
+
+    def read_image(self, dev):
+        return self.images[dev.addr]
@@ -0,0 +1,194 @@
+"""
+PCIe tuning engine
+
+Rules declare what a register should be set to.  A Tuner walks each PCIe
+hierarchy (everything below a root port) once, using the limits from
+PCIDevices.payload_limits(), works out every change the rules want without
+writing anything, then applies the plan in topology order with one batched
+write per device.  MaxPayload is set across the whole hierarchy, the other
+rules only touch the selected devices.  SR-IOV VFs are left alone, their
+copies of these fields are reserved.
+
+
+    dl = PCIDevices(lazy=True, snapshot=True)
+    tuner = Tuner(dl)
+    plan = tuner.plan(select=dl.get(vendor=0x15b3))
+    for change in plan:
+        print change
+    tuner.apply(plan)
+
+Running it again once applied gives an empty plan.
+"""
+
+bytes_size = [ 128, 256, 512, 1024, 2048, 4096 ]
+
+####################################################################
+#### Rules
+####################################################################
+
+class TuningRule:
+    """
+    Sets reg to whatever target() returns, None leaves it alone.  Only
+    applies to the devices the plan was for, unless hierarchy is set, then
+    it's every PCIe device in their hierarchies.
+    """
+    name = None
+    reg = None
+    hierarchy = False
+
+    def applies(self, dev, tuner):
+        return self.hierarchy or tuner.selected(dev)
+
+    def target(self, dev, tuner):
+        return None
+
+class MaxPayloadRule(TuningRule):
+    """
+    Every device in a hierarchy gets the largest MaxPayload that all of them
+    support, across every branch below the root port and not just the path
+    to one endpoint
+    """
+    name = "MaxPayload"
+    reg = "pcie_device_control_max_payload_size"
+    hierarchy = True
+
+    def target(self, dev, tuner):
+        return tuner.hierarchy_max_payload(dev)
+
+class MaxReadReqRule(TuningRule):
+    """
+    MaxReadReq to size bytes, or only up to it if raise_only.  With no size
+    it's the hierarchy's MaxPayload, what Linux's pci=pcie_bus_perf does.
+    """
+    name = "MaxReadReq"
+    reg = "pcie_device_control_max_read_request_size"
+
+    def __init__(self, size=4096, raise_only=False):
+        self.value = None
+        if size is not None:
+            self.value = bytes_size.index(size)
+        self.raise_only = raise_only
+
+    def target(self, dev, tuner):
+        value = self.value
+        if value is None:
+            value = tuner.safe_max_read_req(dev)
+        if self.raise_only and tuner.read(dev, self.reg) >= value:
+            return None
+        return value
+
+class SupportedFeatureRule(TuningRule):
+    "Turn on an enable bit wherever the matching capability bit says it's supported"
+    def __init__(self, name, supported_reg, reg):
+        self.name = name
+        self.supported_reg = supported_reg
+        self.reg = reg
+
+    def target(self, dev, tuner):
+        if tuner.read(dev, self.supported_reg):
+            return 1
+        return None
+
+extended_tag_rule = SupportedFeatureRule("Extended Tag",
+        "pcie_device_capabilities_extended_tag_field_supported",
+        "pcie_device_control_extended_tag_field_enable")
+
+phantom_functions_rule = SupportedFeatureRule("Phantom Functions",
+        "pcie_device_capabilities_phantom_functions_supported",
+        "pcie_device_control_phantom_functions_enable")
+
+default_rules = [
+    MaxPayloadRule(),
+    MaxReadReqRule(4096),
+    extended_tag_rule,
+]
+
+####################################################################
+#### Tuner
+####################################################################
+
+class TuningChange:
+    def __init__(self, dev, rule, current, value):
+        self.dev = dev
+        self.rule = rule
+        self.reg = rule.reg
+        self.current = current
+        self.value = value
+
+    def __str__(self):
+        return "%s %s: %s = %d -> %d" % (self.dev.addr, self.rule.name, self.reg, self.current, self.value)
+
+class Tuner:
+    def __init__(self, devices, rules=None):
+        self.devices = devices
+        if rules is None:
+            rules = default_rules
+        self.rules = rules
+        # (addr, reg) -> value, every register is only read once per plan
+        self.values = {}
+        # addr -> PayloadLimits, see PCIDevices.payload_limits()
+        self.limits = {}
+        # Addresses plan() was given, None for every device
+        self.select = None
+
+    def read(self, dev, reg):
+        key = (dev.addr, reg)
+        try:
+            return self.values[key]
+        except KeyError:
+            value = self.values[key] = dev.config.read(reg)
+            return value
+
+    def selected(self, dev):
+        return self.select is None or dev.addr in self.select
+
+    def hierarchy_max_payload(self, dev):
+        return self.limits[dev.addr].max_payload
+
+    def safe_max_read_req(self, dev):
+        return self.limits[dev.addr].max_read_req
+
+    def plan(self, select=None):
+        "List of TuningChanges in topology order, nothing is written"
+        self.values = {}
+        plan = []
+        self.limits = self.devices.payload_limits()
+        self.select = None
+        if select is not None:
+            self.select = set([dev.addr for dev in select])
+        for top in self.devices.hierarchies(select):
+            # Parents first, payload_limits() only has the PCIe devices
+            devs = [d for d in self.devices.walk_subtree(top)
+                    if d.addr in self.limits and not d.is_virtfn()]
+            for dev in devs:
+                for rule in self.rules:
+                    if not rule.applies(dev, self):
+                        continue
+                    value = rule.target(dev, self)
+                    if value is None:
+                        continue
+                    current = self.read(dev, rule.reg)
+                    if value != current:
+                        plan.append(TuningChange(dev, rule, current, value))
+        return plan
+
+    def apply(self, plan):
+        apply_plan(plan)
+        self.values = {}
+
+def apply_plan(plan):
+    """
+    Write a plan, anything with dev, reg and value attributes, one batch per
+    device with the devices in plan order
+    """
+    batches = []
+    by_addr = {}
+    for change in plan:
+        batch = by_addr.get(change.dev.addr)
+        if batch is None:
+            batch = by_addr[change.dev.addr] = change.dev.config.batch()
+            batches.append(batch)
+        batch.write(change.reg, change.value)
+
+    for batch in batches:
+        batch.commit()
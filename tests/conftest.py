@@ -0,0 +1,9 @@
+import pytest
+from benchmarks.synthetic import Topology, generate
+
+@pytest.fixture
+def sysfs_root(tmpdir):
+    "A small writable generated tree: host bridge, a switch and two endpoints"
+    root = str(tmpdir.join("sys"))
+    generate(root, Topology(root_ports=1, switch_depth=1, switch_ports=2, functions=1, vfs=2))
+    return root
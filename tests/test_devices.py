@@ -0,0 +1,64 @@
+from pcitweak.devices import PCIDevices, PCIDeviceAddress
+from benchmarks.synthetic import Topology, generate
+
+def test_capability_lookup_leaves_config_unbuilt(sysfs_root):
+    dl = PCIDevices(lazy=True, sysfs_root=sysfs_root)
+    dev = dl.get(addr="0000:03:00.0")[0]
+    pcie = dev.capability(0x10)
+    assert pcie.read("pcie_device_capabilities_max_payload_size_supported") == 2
+    assert dev.capability(0x0e, extended=True).base_offset == 0x144
+    assert dev.capability(0x0d) is None
+    assert dev.capability(0x0b, extended=True) is None
+    assert dev._config_pending
+
+    pcie.write("pcie_device_control_max_payload_size", 1)
+    # config takes over the access the lookup opened
+    access = dev._access
+    assert dev.config.config is access
+    assert dev.config.read("pcie_device_control_max_payload_size") == 1
+    assert dev.capability(0x10).base_offset == pcie.base_offset
+    dl.close()
+    assert access.backend.config.closed
+
+def raise_root_port_payload(sysfs_root):
+    "The generated root ports only support 256 bytes, let the endpoints be the limit"
+    dl = PCIDevices(sysfs_root=sysfs_root)
+    dl.get(addr="0000:00:01.0")[0].config.write("pcie_device_capabilities_max_payload_size_supported", 3)
+    dl.close()
+
+def test_payload_limits_of_mixed_hierarchy(tmpdir):
+    root = str(tmpdir.join("sys"))
+    # Endpoints supporting 512 (Mellanox, Intel) and 256 (Broadcom, Samsung)
+    # bytes behind one switch
+    generate(root, Topology(root_ports=1, switch_depth=1, switch_ports=4, functions=1, vfs=0))
+    raise_root_port_payload(root)
+    limits = PCIDevices(sysfs_root=root).payload_limits()
+
+    subtree = dict([(str(addr), limit.subtree) for addr, limit in limits.items()])
+    assert subtree == {
+        "0000:00:01.0": 1, "0000:01:00.0": 1,
+        "0000:02:00.0": 2, "0000:03:00.0": 2,
+        "0000:02:01.0": 2, "0000:04:00.0": 2,
+        "0000:02:02.0": 1, "0000:05:00.0": 1,
+        "0000:02:03.0": 1, "0000:06:00.0": 1,
+    }
+    # Every device gets what the whole hierarchy supports
+    assert set([limit.max_payload for limit in limits.values()]) == set([1])
+    assert set([limit.max_read_req for limit in limits.values()]) == set([1])
+
+def test_payload_limits_follow_the_endpoints(sysfs_root):
+    raise_root_port_payload(sysfs_root)
+    limits = PCIDevices(sysfs_root=sysfs_root).payload_limits()
+    assert limits[PCIDeviceAddress.parse("0000:00:01.0")].subtree == 2
+    assert set([limit.max_payload for limit in limits.values()]) == set([2])
+    # The host bridge isn't below a root port
+    assert PCIDeviceAddress.parse("0000:00:00.0") not in limits
+
+def test_read_image_leaves_config_unbuilt(sysfs_root):
+    dl = PCIDevices(lazy=True, sysfs_root=sysfs_root)
+    dev = dl.get(addr="0000:03:00.0")[0]
+    image = dl.read_image(dev)
+    assert len(image) == 4096
+    assert dev._config_pending and dev._access is None
+    assert image == dev.config.config.read_block(0, 4096)
+    assert dl.read_image(dev) == image
@@ -0,0 +1,22 @@
+import os
+from pcitweak.devices import PCIDevices
+from pcitweak.monitor import Monitor
+
+def test_unreadable_device_doesnt_stop_the_others(sysfs_root):
+    dl = PCIDevices(lazy=True, sysfs_root=sysfs_root)
+    mon = Monitor(dl, dl.get(addr="0000:03:00.0") + dl.get(addr="0000:04:00.0"))
+    # Unplugged: the open config file now ends before the PCIe capability
+    f = open(os.path.join(sysfs_root, "devices", "pci0000:00", "0000:00:01.0", "0000:01:00.0",
+                          "0000:02:00.0", "0000:03:00.0", "config"), "r+b")
+    f.truncate(0x40)
+    f.close()
+
+    samples = list(mon.samples(interval=0, count=2))
+    assert len(samples) == 4
+    for sample in samples:
+        if str(sample.addr) == "0000:03:00.0":
+            assert sample.values is None
+            assert isinstance(sample.error, IOError)
+        else:
+            assert sample.error is None
+            assert sample.values["pcie_link_status_negotiated_link_width"] > 0
@@ -0,0 +1,58 @@
+import pytest
+from pcitweak.devices import PCIDevices
+from pcitweak.archive import PCIArchiveDevices, restore_plan
+from pcitweak.diff import diff_devices
+from pcitweak.tuning import apply_plan
+
+# (addr, register or field, value written after saving)
+tweaks = [
+    ("0000:03:00.0", "pcie_device_control_max_payload_size", 1),
+    ("0000:03:00.0", "pcie_device_control_max_read_request_size", 5),
+    ("0000:03:00.0", "aer_correctable_error_mask", 0x3000),
+    ("0000:02:00.0", "common_command_bus_master_enable", 0),
+    ("0000:00:01.0", "l1ss_control1", 0xf),
+]
+
+def test_restore_round_trip(sysfs_root, tmpdir):
+    filename = str(tmpdir.join("baseline.pcia"))
+    PCIDevices(sysfs_root=sysfs_root).save(filename)
+
+    dl = PCIDevices(sysfs_root=sysfs_root)
+    for addr, name, value in tweaks:
+        dl.get(addr=addr)[0].config.write(name, value)
+
+    saved = PCIArchiveDevices(filename)
+    try:
+        changed = diff_devices(saved, PCIDevices(sysfs_root=sysfs_root))
+        assert sorted([str(addr) for addr in changed]) == sorted(set([addr for addr, name, value in tweaks]))
+
+        plan = restore_plan(saved, PCIDevices(sysfs_root=sysfs_root))
+        # The two device control fields are one register
+        assert len(plan) == 4
+        apply_plan(plan)
+
+        after = PCIDevices(sysfs_root=sysfs_root)
+        assert restore_plan(saved, after) == []
+        assert diff_devices(saved, after) == {}
+    finally:
+        saved.close()
+
+def test_archive_is_read_only(sysfs_root, tmpdir):
+    filename = str(tmpdir.join("baseline.pcia"))
+    PCIDevices(sysfs_root=sysfs_root).save(filename)
+    saved = PCIArchiveDevices(filename)
+    try:
+        dev = saved.get(addr="0000:03:00.0")[0]
+        with pytest.raises(IOError):
+            dev.config.write("pcie_device_control_max_payload_size", 1)
+    finally:
+        saved.close()
+
+def test_closed_archive(sysfs_root, tmpdir):
+    filename = str(tmpdir.join("baseline.pcia"))
+    PCIDevices(sysfs_root=sysfs_root).save(filename)
+    with PCIArchiveDevices(filename) as saved:
+        dev = saved.get(addr="0000:03:00.0")[0]
+        assert dev.config.read("common_vendor_id") == dev.vendor
+    assert saved.mm is None
+    assert dev.config is None
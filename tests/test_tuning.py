@@ -0,0 +1,36 @@
+from pcitweak.devices import PCIDevices
+from pcitweak.tuning import Tuner, default_rules, phantom_functions_rule
+
+def changed(plan):
+    return set([(str(change.dev.addr), change.rule.name) for change in plan])
+
+def test_only_max_payload_is_hierarchy_wide(sysfs_root):
+    dl = PCIDevices(sysfs_root=sysfs_root)
+    tuner = Tuner(dl, default_rules + [phantom_functions_rule])
+    plan = changed(tuner.plan(select=dl.get(vendor=0x15b3)))
+    # The Intel endpoint behind the same switch only gets MaxPayload
+    assert ("0000:04:00.0", "MaxPayload") in plan
+    assert ("0000:04:00.0", "MaxReadReq") not in plan
+    assert ("0000:04:00.0", "Extended Tag") not in plan
+    assert ("0000:03:00.0", "MaxReadReq") in plan
+    assert ("0000:03:00.0", "Extended Tag") in plan
+
+def test_vfs_are_left_alone(sysfs_root):
+    dl = PCIDevices(sysfs_root=sysfs_root)
+    assert dl.get(addr="0000:03:00.1")[0].is_virtfn()
+    assert not dl.get(addr="0000:03:00.0")[0].is_virtfn()
+    plan = changed(Tuner(dl).plan())
+    assert ("0000:03:00.0", "MaxReadReq") in plan
+    assert not [addr for addr, name in plan if addr.endswith((".1", ".2"))]
+
+def test_plan_is_empty_once_applied(sysfs_root):
+    dl = PCIDevices(lazy=True, snapshot=True, sysfs_root=sysfs_root)
+    tuner = Tuner(dl, default_rules + [phantom_functions_rule])
+    plan = tuner.plan()
+    assert plan
+    tuner.apply(plan)
+    assert tuner.plan() == []
+
+    # Also as seen from a new discovery
+    dl = PCIDevices(sysfs_root=sysfs_root)
+    assert Tuner(dl, default_rules + [phantom_functions_rule]).plan() == []
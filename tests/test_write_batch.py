@@ -0,0 +1,122 @@
+import os
+import pytest
+from pcitweak.config import SysfsConfigBackend
+from pcitweak.devices import PCIDevices
+
+class CountingBackend(SysfsConfigBackend):
+    "Records every (offset, data) written"
+    def __init__(self, config_fn):
+        SysfsConfigBackend.__init__(self, config_fn)
+        self.writes = []
+
+    def write(self, offset, data):
+        self.writes.append((offset, data))
+        SysfsConfigBackend.write(self, offset, data)
+
+def endpoint(sysfs_root):
+    dl = PCIDevices(sysfs_root=sysfs_root,
+                    backend=lambda dev: CountingBackend(os.path.join(dev.path, "config")))
+    dev = dl.get(addr="0000:03:00.0")[0]
+    return dev, dev.config.config.backend
+
+def test_fields_of_one_register_are_merged(sysfs_root):
+    dev, backend = endpoint(sysfs_root)
+    devctl = dev.config.find_capability(0x10) + 0x08
+    before = dev.config.read("pcie_device_control")
+
+    batch = dev.config.batch()
+    batch.write("pcie_device_control_max_payload_size", 1)
+    batch.write("pcie_device_control_max_read_request_size", 5)
+    batch.commit()
+
+    assert len(backend.writes) == 1
+    assert backend.writes[0][0] == devctl
+    assert len(backend.writes[0][1]) == 2
+    assert dev.config.read("pcie_device_control_max_payload_size") == 1
+    assert dev.config.read("pcie_device_control_max_read_request_size") == 5
+    # Bits outside the two fields are kept
+    assert dev.config.read("pcie_device_control") & ~0x70e0 == before & ~0x70e0
+
+    # A new discovery sees what landed in the file
+    dev, backend = endpoint(sysfs_root)
+    assert dev.config.read("pcie_device_control_max_read_request_size") == 5
+
+def test_registers_are_written_in_offset_order(sysfs_root):
+    dev, backend = endpoint(sysfs_root)
+    batch = dev.config.batch()
+    batch.write("pcie_device_control_max_payload_size", 1)
+    batch.write("common_command_bus_master_enable", 1)
+    batch.commit()
+    offsets = [offset for offset, data in backend.writes]
+    assert offsets == sorted(offsets)
+    assert len(offsets) == 2
+
+def test_empty_commit_writes_nothing(sysfs_root):
+    dev, backend = endpoint(sysfs_root)
+    dev.config.batch().commit()
+    assert backend.writes == []
+
+    batch = dev.config.batch()
+    batch.write("pcie_device_control_max_payload_size", 1)
+    batch.commit()
+    del backend.writes[:]
+    # Committed writes aren't applied again
+    batch.commit()
+    assert backend.writes == []
+
+def test_with_block_only_commits_on_success(sysfs_root):
+    dev, backend = endpoint(sysfs_root)
+    with pytest.raises(ValueError):
+        with dev.config.batch() as batch:
+            batch.write("pcie_device_control_max_payload_size", 1)
+            raise ValueError()
+    assert backend.writes == []
+
+    with dev.config.batch() as batch:
+        batch.write("pcie_device_control_max_payload_size", 1)
+    assert len(backend.writes) == 1
+
+def test_write_and_clear_of_one_register_is_refused(sysfs_root):
+    dev, backend = endpoint(sysfs_root)
+    batch = dev.config.batch()
+    batch.write("pcie_device_control_max_payload_size", 1)
+    batch.clear("pcie_device_control_max_payload_size")
+    with pytest.raises(RuntimeError):
+        batch.commit()
+    assert backend.writes == []
+
+def test_snapshot_writes_keep_changes_made_since(sysfs_root):
+    snap = PCIDevices(snapshot=True, sysfs_root=sysfs_root).get(addr="0000:03:00.0")[0]
+    live = PCIDevices(sysfs_root=sysfs_root).get(addr="0000:03:00.0")[0]
+
+    live.config.write("pcie_device_control_max_read_request_size", 5)
+    snap.config.write("pcie_device_control_max_payload_size", 1)
+    assert live.config.read("pcie_device_control_max_read_request_size") == 5
+    # The snapshot is refreshed from what was written
+    assert snap.config.read("pcie_device_control_max_read_request_size") == 5
+
+    live.config.write("pcie_device_control_max_read_request_size", 3)
+    with snap.config.batch() as batch:
+        batch.write("pcie_device_control_max_payload_size", 0)
+    assert live.config.read("pcie_device_control_max_read_request_size") == 3
+    assert live.config.read("pcie_device_control_max_payload_size") == 0
+
+def test_refused_batch_writes_nothing(sysfs_root):
+    dev, backend = endpoint(sysfs_root)
+    batch = dev.config.batch()
+    batch.write("common_command_bus_master_enable", 1)
+    batch.write("pcie_device_control_max_payload_size", 1)
+    batch.write("pcie_device_status_correctable_error_detected", 0)
+    batch.clear("pcie_device_status_correctable_error_detected")
+    words = dict((key, list(word)) for key, word in batch.words.items())
+    with pytest.raises(RuntimeError):
+        batch.commit()
+    # Not even the registers below the conflicting one
+    assert backend.writes == []
+    assert batch.words == words
+
+    with pytest.raises(ValueError):
+        batch.write("common_command", 0x10000)
+    with pytest.raises(ValueError):
+        batch.write("pcie_device_control_max_payload_size", 8)
+    assert batch.words == words